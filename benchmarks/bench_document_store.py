@@ -0,0 +1,94 @@
+'''
+Compare document load/save throughput of the old pydantic v1 style paths with
+DocumentStore, and time a JSON Lines export and import of the whole store.
+
+    python benchmarks/bench_document_store.py --sizes 1000 10000
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import warnings
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synthetic_library import SyntheticLibrary
+from document_index import DocumentIndex
+from document_store import Document, DocumentHighlight, DocumentNote, DocumentStore
+
+def make_documents(n_documents: int, annotations: int):
+    library = SyntheticLibrary(0, seed=n_documents)
+    return [
+        Document(
+            key=f"K{i:07d}", version=1, title=f"Study {i}", abstract=library.paragraph(), collections=[],
+            annotations=[DocumentHighlight(text=library.sentence(), mtime=library.timestamp()) for _ in range(annotations)],
+            notes=[DocumentNote(text=library.sentence(), mtime=library.timestamp()) for _ in range(annotations // 4)]
+        )
+        for i in range(n_documents)
+    ]
+
+def per_second(n: int, fn, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return round(n / best, 1)
+
+def legacy_save(index: DocumentIndex, documents):
+    for document in documents:
+        index.write_document(document.key, document.json())
+
+def legacy_load(data_path: str, keys):
+    for key in keys:
+        with open(f"{data_path}/{key}.json") as file:
+            Document.parse_obj(json.load(file))
+
+def bench_store(n_documents: int, args) -> dict:
+    documents = make_documents(n_documents, args.annotations)
+    keys = [document.key for document in documents]
+    results = {'documents': n_documents}
+    with tempfile.TemporaryDirectory() as root:
+        legacy_path, store_path, import_path = (f"{root}/{name}" for name in ('legacy', 'store', 'import'))
+        for path in (legacy_path, store_path, import_path):
+            os.makedirs(path)
+
+        results['legacy_save_per_second'] = per_second(n_documents, lambda: legacy_save(DocumentIndex(legacy_path), documents), args.repeat)
+        results['legacy_load_per_second'] = per_second(n_documents, lambda: legacy_load(legacy_path, keys), args.repeat)
+
+        store = DocumentStore(store_path)
+        results['store_save_per_second'] = per_second(n_documents, lambda: store.save_many(documents), args.repeat)
+        results['store_load_per_second'] = per_second(n_documents, lambda: deque(store.load_many(keys), maxlen=0), args.repeat)
+
+        export_path = f"{root}/library.jsonl{'.gz' if args.gzip else ''}"
+        results['export_per_second'] = per_second(n_documents, lambda: store.export_jsonl(export_path), args.repeat)
+        results['export_bytes'] = os.path.getsize(export_path)
+        results['import_per_second'] = per_second(n_documents, lambda: DocumentStore(import_path).import_jsonl(export_path), args.repeat)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--annotations', type=int, default=20, help='highlights per document')
+    parser.add_argument('--repeat', type=int, default=3, help='report the best of this many runs')
+    parser.add_argument('--gzip', action='store_true', help='gzip the JSON Lines export')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+    # The legacy paths are deprecated in pydantic v2
+    warnings.simplefilter('ignore', DeprecationWarning)
+
+    results = []
+    for n_documents in args.sizes:
+        result = bench_store(n_documents, args)
+        print(json.dumps(result))
+        results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
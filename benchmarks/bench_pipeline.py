@@ -0,0 +1,107 @@
+'''
+Time the sync pipeline against a synthetic library served by a local fake Zotero API.
+
+    python benchmarks/bench_pipeline.py --sizes 100 1000 10000 --latency 0.02
+
+With --trace-memory each stage also reports the peak memory it allocated on top of what
+was live when it started ({stage}_peak_mb), which should stay roughly flat as the library
+grows. max_rss_mb is the process's peak resident set size so far, and includes the
+synthetic library and fake server; run one size per invocation to compare it.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tracemalloc
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synthetic_library import SyntheticLibrary
+from fake_zotero_server import FakeZoteroServer
+from zotero_client import ZoteroClient
+from request_scheduler import RequestScheduler
+from document_client import DocumentClient
+from keyword_client import KeywordClient
+from graph_client import GraphClient
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'templates')
+
+def timed(results: dict, name: str, fn):
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        live = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    value = fn()
+    results[name] = round(time.perf_counter() - start, 3)
+    if tracing:
+        results[f"{name}_peak_mb"] = round((tracemalloc.get_traced_memory()[1] - live) / 2**20, 1)
+    return value
+
+def max_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 2**20 if sys.platform == 'darwin' else 2**10
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1)
+
+def bench_library(n_items: int, args) -> dict:
+    library = SyntheticLibrary(n_items, seed=n_items)
+    results = {'items': n_items}
+    with tempfile.TemporaryDirectory() as root, \
+            FakeZoteroServer(library, latency=args.latency, throttle_every=args.throttle_every) as server:
+        data_path = f"{root}/data"
+        graph_path = f"{root}/graph"
+        for path in (data_path, f"{graph_path}/pages", f"{graph_path}/journals"):
+            os.makedirs(path)
+
+        scheduler = RequestScheduler(rate=args.rate, burst=args.rate, max_concurrency=args.workers)
+        zotero_client = ZoteroClient('1', 'benchmark', base_url=server.url, scheduler=scheduler)
+        document_client = DocumentClient(zotero_client, data_path, graph_path, max_workers=args.workers)
+
+        timed(results, 'sync_documents', document_client.sync_documents)
+        results['sync_requests'] = server.request_count
+        timed(results, 'sync_documents_noop', document_client.sync_documents)
+
+        library.modify(library.top_level_keys()[:max(1, n_items // 100)])
+        timed(results, 'sync_documents_1pct', document_client.sync_documents)
+
+        keyword_client = timed(results, 'detect_keywords', lambda: KeywordClient(data_path, [], args.ner_processes))
+        results['keywords'] = len(keyword_client.keywords)
+
+        graph_client = GraphClient(data_path, graph_path, TEMPLATE_PATH, keyword_client, args.render_processes)
+        timed(results, 'sync_graph', graph_client.sync_graph)
+        timed(results, 'sync_graph_noop', graph_client.sync_graph)
+        timed(results, 'keyword_pages', lambda: keyword_client.write_keyword_pages(graph_path))
+        results['scheduler'] = scheduler.metrics()
+    results['max_rss_mb'] = max_rss_mb()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every API response')
+    parser.add_argument('--throttle-every', type=int, default=0, help='answer every Nth request with 429')
+    parser.add_argument('--rate', type=float, default=1000.0, help='client request rate limit per second')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--ner-processes', type=int, default=1)
+    parser.add_argument('--render-processes', type=int, default=1)
+    parser.add_argument('--trace-memory', action='store_true', help='report peak allocations per stage (slower)')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+    if args.trace_memory:
+        tracemalloc.start()
+
+    results = []
+    for n_items in args.sizes:
+        result = bench_library(n_items, args)
+        print(json.dumps(result))
+        results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
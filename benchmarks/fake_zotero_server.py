@@ -0,0 +1,132 @@
+import re
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+class FakeZoteroServer:
+    '''
+    Local stand-in for the Zotero Web API endpoints used by ZoteroClient, serving a
+    SyntheticLibrary. Every response is delayed by latency seconds, and every
+    throttle_every-th request is answered with 429 and a Retry-After header.
+
+        with FakeZoteroServer(library, latency=0.05) as server:
+            zotero_client = ZoteroClient('1', 'key', base_url=server.url)
+    '''
+    def __init__(self, library, latency: float = 0.0, throttle_every: int = 0, retry_after: float = 0.1):
+        self.library = library
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.request_count = 0
+        self.requests_by_endpoint = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _count(self, endpoint: str) -> int:
+        with self._lock:
+            self.request_count += 1
+            self.requests_by_endpoint[endpoint] = self.requests_by_endpoint.get(endpoint, 0) + 1
+            return self.request_count
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, body, headers=None):
+                content = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.send_header('Last-Modified-Version', str(fake.library.version))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def send_status(self, status, headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {name: values[0] for name, values in parse_qs(url.query).items()}
+                match = re.match(r'^/(users|groups)/[^/]+/(.*)$', url.path)
+                if not match:
+                    return self.send_status(404)
+                path = match.group(2)
+                endpoint = re.sub(r'items/[A-Z0-9]+', 'items/{key}', path)
+                n = fake._count(endpoint)
+
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fake.throttle_every and n % fake.throttle_every == 0:
+                    return self.send_status(429, {'Retry-After': str(fake.retry_after)})
+
+                library = fake.library
+                since_version = self.headers.get('If-Modified-Since-Version')
+                if since_version is not None and int(since_version) >= library.version:
+                    return self.send_status(304, {'Last-Modified-Version': str(library.version)})
+
+                since = int(query.get('since', 0))
+                if path == 'items/top' and query.get('format') == 'versions':
+                    return self.send_json({
+                        key: library.items[key]['version'] for key in library.top_level_keys()
+                        if library.items[key]['version'] > since
+                    })
+                if path == 'deleted':
+                    return self.send_json({
+                        'items': [key for key, version in library.deleted.items() if version > since],
+                        'collections': [], 'searches': [], 'tags': [], 'settings': [],
+                    })
+                if path == 'items':
+                    if 'itemKey' in query:
+                        keys = query['itemKey'].split(',')
+                        return self.send_json([library.items[key] for key in keys if key in library.items])
+                    item_types = {t.strip() for t in query.get('itemType', '').split('||') if t.strip()}
+                    items = [item for item in library.items.values()
+                             if not item_types or item['data']['itemType'] in item_types]
+                    start = int(query.get('start', 0))
+                    limit = int(query.get('limit', 25))
+                    return self.send_json(items[start:start + limit], {'Total-Results': str(len(items))})
+
+                match = re.match(r'^items/([A-Z0-9]+)(/children|/file)?$', path)
+                if not match or match.group(1) not in library.items:
+                    return self.send_status(404)
+                key, suffix = match.groups()
+                if suffix is None:
+                    return self.send_json(library.items[key])
+                if suffix == '/children':
+                    children = library.children(key)
+                    if 'itemType' in query:
+                        children = [child for child in children if child['data']['itemType'] == query['itemType']]
+                    return self.send_json(children)
+                content = library.files.get(key)
+                if content is None:
+                    return self.send_status(404)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/zip')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        return Handler
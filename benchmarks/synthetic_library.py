@@ -0,0 +1,127 @@
+import io
+import hashlib
+import random
+import zipfile
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+PLACES = ['Accra', 'Kumasi', 'Tamale', 'Nairobi', 'Lagos', 'London', 'Geneva', 'Boston', 'Lima', 'Hanoi']
+ORGANISATIONS = ['the World Health Organization', 'UNICEF', 'the Wellcome Trust', 'Google', 'Vodafone',
+                 'the Ministry of Health', 'the Gates Foundation', 'MSF']
+TOPICS = ['mobility', 'transmission', 'vaccination', 'surveillance', 'forecasting', 'contact tracing',
+          'mobile phone data', 'non-pharmaceutical interventions', 'hospital capacity', 'seroprevalence']
+
+class SyntheticLibrary:
+    '''
+    A generated Zotero library shaped like the API's JSON: top-level items, PDF and
+    Kindle notebook attachments, PDF annotations and HTML child notes. Items can be
+    modified or deleted to exercise incremental syncs.
+    '''
+    def __init__(self, n_items: int, annotations_per_pdf: int = 10, notes_per_item: int = 1,
+                 kindle_every: int = 20, seed: int = 0):
+        self.random = random.Random(seed)
+        self.version = 1
+        self.items = {}
+        self.files = {}
+        self.deleted = {}
+        self.children_keys = defaultdict(list)
+        self.start = datetime(2020, 1, 1)
+        self._next_key = 0
+        self.n_items = 0
+        for _ in range(n_items):
+            self.add_item(annotations_per_pdf, notes_per_item, kindle_every)
+
+    def new_key(self) -> str:
+        self._next_key += 1
+        return f"K{self._next_key:07d}"
+
+    def timestamp(self) -> str:
+        dt = self.start + timedelta(minutes=self.random.randrange(5 * 365 * 24 * 60))
+        return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def sentence(self) -> str:
+        return (f"Work in {self.random.choice(PLACES)} with {self.random.choice(ORGANISATIONS)} "
+                f"studied {self.random.choice(TOPICS)} and {self.random.choice(TOPICS)}.")
+
+    def paragraph(self, n_sentences: int = 3) -> str:
+        return ' '.join(self.sentence() for _ in range(n_sentences))
+
+    def notebook_zip(self, n_highlights: int) -> bytes:
+        highlights = ''.join(
+            f"<h3 class='noteHeading'>Highlight (<span class='highlight_yellow'>yellow</span>) - Location {i}</h3>\n"
+            f"<div class='noteText'>{self.sentence()}</div>\n"
+            for i in range(n_highlights)
+        )
+        html = f"<html><head><title>Notebook</title></head><body><div class='bodyContainer'>{highlights}</div></body></html>"
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('Notebook.html', html)
+        return buffer.getvalue()
+
+    def _put(self, key: str, data: dict):
+        data['key'] = key
+        data['version'] = self.version
+        data.setdefault('dateModified', self.timestamp())
+        self.items[key] = {'key': key, 'version': self.version, 'data': data}
+        if 'parentItem' in data:
+            self.children_keys[data['parentItem']].append(key)
+
+    def add_item(self, annotations_per_pdf: int, notes_per_item: int, kindle_every: int) -> str:
+        key = self.new_key()
+        self.n_items += 1
+        index = self.n_items
+        self._put(key, {
+            'itemType': 'journalArticle',
+            'title': f"{self.random.choice(TOPICS).capitalize()} in {self.random.choice(PLACES)}: study {index}",
+            'abstractNote': self.paragraph(),
+            'collections': [],
+        })
+
+        attachment_key = self.new_key()
+        if kindle_every and index % kindle_every == 0:
+            notebook = self.notebook_zip(annotations_per_pdf)
+            self._put(attachment_key, {'itemType': 'attachment', 'parentItem': key,
+                                       'filename': f"Study {index} - Notebook.html", 'contentType': 'text/html',
+                                       'md5': hashlib.md5(notebook).hexdigest()})
+            self.files[attachment_key] = notebook
+        else:
+            self._put(attachment_key, {'itemType': 'attachment', 'parentItem': key,
+                                       'filename': f"study-{index}.pdf", 'contentType': 'application/pdf'})
+            for i in range(annotations_per_pdf):
+                annotation = {'itemType': 'annotation', 'parentItem': attachment_key}
+                if i % 4 == 3:
+                    annotation.update({'annotationType': 'note', 'annotationComment': self.sentence()})
+                else:
+                    annotation.update({'annotationType': 'highlight', 'annotationText': self.sentence()})
+                self._put(self.new_key(), annotation)
+
+        for _ in range(notes_per_item):
+            paragraphs = ''.join(f"<p>{self.paragraph(2)}</p>" for _ in range(3))
+            self._put(self.new_key(), {'itemType': 'note', 'parentItem': key,
+                                       'note': f"<h1>Notes</h1>{paragraphs}<ul><li>{self.sentence()}</li></ul>"})
+        return key
+
+    def top_level_keys(self):
+        return [key for key, item in self.items.items() if 'parentItem' not in item['data']]
+
+    def children(self, parent_key: str):
+        return [self.items[key] for key in self.children_keys.get(parent_key, []) if key in self.items]
+
+    def modify(self, keys):
+        '''
+        Bump the version of top-level items, as editing them in Zotero would
+        '''
+        self.version += 1
+        for key in keys:
+            self.items[key]['version'] = self.version
+            self.items[key]['data']['version'] = self.version
+
+    def delete(self, keys):
+        self.version += 1
+        for key in keys:
+            for child in self.children(key):
+                for grandchild in self.children(child['key']):
+                    del self.items[grandchild['key']]
+                del self.items[child['key']]
+            del self.items[key]
+            self.deleted[key] = self.version
@@ -1,50 +1,103 @@
 import os
+import json
+import math
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from itertools import islice
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup
 from zotero_client import (
     ZoteroClient,
     ZoteroDocument,
+    ZoteroAttachment,
     ZoteroAttachmentHighlight,
     ZoteroNote,
-    ZoteroNoteData
+    ZoteroNoteData,
+    NOTE_PARSER_VERSION,
+    note_blocks
 )
-from pydantic import BaseModel
-from typing import List, Optional
-
-class DocumentHighlight(BaseModel):
-    text: str
-    mtime: str
-
-class DocumentNote(BaseModel):
-    text: str
-    mtime: str
-
-class Document(BaseModel):
-    key: str
-    version: int
-    title: str
-    abstract: Optional[str]
-    collections: list[str]
-    annotations: list[DocumentHighlight]
-    notes: list[DocumentNote]
+from document_index import write_atomic
+from document_store import Document, DocumentHighlight, DocumentNote, DocumentStore
+from item_spool import ItemSpool
+from run_report import RunReport
+from sync_budget import SyncBudget
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+CHILD_ITEM_TYPES = "attachment || note || annotation"
+SYNC_PRIORITIES = ('recent', 'annotated')
+
+def completed(executor: ThreadPoolExecutor, fn, items: Iterable, max_pending: int):
+    '''
+    Yield (item, future) as calls of fn(item) complete, submitting items lazily so at most
+    max_pending futures exist at a time
+    '''
+    items = iter(items)
+    pending = {}
+    while True:
+        for item in items:
+            pending[executor.submit(fn, item)] = item
+            if len(pending) >= max_pending:
+                break
+        if not pending:
+            return
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield pending.pop(future), future
 
 class DocumentClient:
-    def __init__(self, zotero_client: ZoteroClient, data_path: str, graph_path: str):
+    def __init__(self, zotero_client: ZoteroClient, data_path: str, graph_path: Optional[str], max_workers: int = 8, requests_per_document: int = 4,
+                 report: Optional[RunReport] = None, max_requests: Optional[int] = None, max_seconds: Optional[float] = None,
+                 priority: str = 'recent', on_progress: Optional[Callable[[], None]] = None, progress_every: int = 100):
+        if priority not in SYNC_PRIORITIES:
+            raise ValueError(f"Sync priority must be one of {', '.join(SYNC_PRIORITIES)}, not {priority!r}")
         self.zotero_client = zotero_client
         self.data_path = data_path
         self.graph_path = graph_path
+        self.max_workers = max_workers
+        self.requests_per_document = requests_per_document
+        self.store = DocumentStore(data_path)
+        self.index = self.store.index
+        self.report = report or RunReport()
+        # Per-run budget, the order documents are synced in, and a callback run every
+        # progress_every synced documents, e.g. to render their pages
+        self.max_requests = max_requests
+        self.max_seconds = max_seconds
+        self.priority = priority
+        self.on_progress = on_progress
+        self.progress_every = progress_every
         
-    def split_note_content(self, note: ZoteroNote):
-        soup = BeautifulSoup(note.data.text, 'html.parser')
-        text = soup.get_text()
-        lines = text.split('\n')
+    def split_note_content(self, note: ZoteroNote, blocks: Optional[List[str]] = None) -> List[ZoteroNote]:
+        if blocks is None:
+            blocks = note_blocks(note.data.text)
         return [ZoteroNote(
             key=note.key,
+            version=note.version,
             data=ZoteroNoteData(
-                note=line,
+                note=block,
                 dateModified=note.data.mtime
             )
-        ) for line in lines if len(line) > 0]
+        ) for block in blocks]
+
+    def split_child_notes(self, parent_key: str, notes: List[ZoteroNote]) -> List[ZoteroNote]:
+        '''
+        Split a document's child notes into blocks, reusing the blocks cached for notes whose
+        key and version haven't changed since they were last parsed
+        '''
+        cached = self.index.note_blocks([note.key for note in notes]) if notes else {}
+        blocks_by_key = {}
+        split = []
+        for note in notes:
+            cache_key = f"{note.version}:{NOTE_PARSER_VERSION}" if note.version is not None else None
+            if cache_key is not None and cached.get(note.key, (None,))[0] == cache_key:
+                blocks = cached[note.key][1]
+                self.report.count('notes_cached')
+            else:
+                blocks = note_blocks(note.data.text)
+                self.report.count('notes_parsed')
+            if cache_key is not None:
+                blocks_by_key[note.key] = (cache_key, blocks)
+            split.extend(self.split_note_content(note, blocks))
+        self.index.set_note_blocks(parent_key, blocks_by_key)
+        return split
 
     def document_from_zotero(
         self,
@@ -53,12 +106,12 @@ class DocumentClient:
         zotero_notes: List[ZoteroNote]) -> Document:
         
         highlights = [
-            DocumentHighlight(**highlight.data.dict())
+            DocumentHighlight(text=highlight.data.text, mtime=highlight.data.mtime, key=highlight.key)
             for highlight in zotero_highlights
         ]
 
         notes = [
-            DocumentNote(**note.data.dict())
+            DocumentNote(text=note.data.text, mtime=note.data.mtime, key=note.key)
             for note in zotero_notes
         ]
 
@@ -72,51 +125,287 @@ class DocumentClient:
             notes=notes
         )
 
+    def write_document(
+        self,
+        zotero_doc: ZoteroDocument,
+        zotero_highlights: List[ZoteroAttachmentHighlight],
+        zotero_notes: List[ZoteroNote],
+        zotero_child_notes: List[ZoteroNote]):
+
+        zotero_notes.extend(self.split_child_notes(zotero_doc.key, zotero_child_notes))
+        document = self.document_from_zotero(zotero_doc, zotero_highlights, zotero_notes)
+
+        self.store.save(document)
+
     def add_document(self, key: str):
         zotero_doc = self.zotero_client.get_document(key)
         
         if zotero_doc is None: # DEV: This won't currently support top-level notes
+            if key in self.index:
+                self.delete_document(key)
             return
         
         zotero_highlights, zotero_notes = self.zotero_client.get_attachment_annotations(key)
-        
-        child_notes = [self.split_note_content(x) for x in self.zotero_client.get_document_child_notes(key)]
-        child_notes = [item for sublist in child_notes for item in sublist]
-        
-        zotero_notes.extend(child_notes)
-        document = self.document_from_zotero(zotero_doc, zotero_highlights, zotero_notes)
+        child_notes = self.zotero_client.get_document_child_notes(key)
+        self.write_document(zotero_doc, zotero_highlights, zotero_notes, child_notes)
 
-        with open(f"{self.data_path}/{key}.json", "w") as f:
-            f.write(document.json())
+    def add_documents(self, keys: List[str], children_by_parent: Dict[str, List[dict]]):
+        '''
+        Build documents for a batch of keys from one multi-key request and child items
+        already grouped by parentItem. Returns a dict of key -> exception for failures.
+        '''
+        failed = {}
+        items = self.zotero_client.get_items(keys)
+        for key in set(keys) - {item['key'] for item in items}:
+            failed[key] = KeyError(f"{key} was not returned by the Zotero API")
+        for item in items:
+            key = item['key']
+            try:
+                if item['data']['itemType'] == 'note':
+                    continue
+                zotero_doc = ZoteroDocument(**item)
+                children = children_by_parent.get(key, [])
+                attachments = [ZoteroAttachment(**x) for x in children if x['data']['itemType'] == 'attachment']
+                child_notes = [ZoteroNote(**x) for x in children if x['data']['itemType'] == 'note']
+                zotero_highlights, zotero_notes = self.zotero_client.collect_attachment_annotations(
+                    attachments, lambda k: children_by_parent.get(k, []))
+                self.report.count('documents_updated' if key in self.index else 'documents_added')
+                self.write_document(zotero_doc, zotero_highlights, zotero_notes, child_notes)
+            except Exception as e:
+                failed[key] = e
+        return failed
         
     def delete_document(self, key: str):
-        os.remove(f"{self.data_path}/{key}.json")        
+        self.store.delete(key)
+
+    def remove_document(self, key: str):
+        '''
+        Remove a document deleted in Zotero along with its page in the graph, if this client
+        writes to one
+        '''
+        if self.graph_path is not None:
+            page = f"{self.graph_path}/{self.index.page_file(key) or self.index.page_path(key)}"
+            if os.path.exists(page):
+                os.remove(page)
+            self.index.set_page_file(key, None)
+        self.delete_document(key)
 
     def update_document(self, key: str):
         print(f"Updating document {key}")
-        self.delete_document(key)
+        # The stored document is only overwritten once the new version has been fetched, so
+        # a failed request leaves it, and its page, in place
         self.add_document(key)
     
+    def read_library_version(self) -> Optional[int]:
+        try:
+            with open(f"{self.data_path}/.library_version") as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return None
+
+    def write_library_version(self, version: int):
+        with open(f"{self.data_path}/.library_version", "w") as f:
+            f.write(str(version))
+
+    def sync_document(self, key: str):
+        if key in self.index:
+            self.report.count('documents_updated')
+            self.update_document(key)
+        else:
+            self.report.count('documents_added')
+            self.add_document(key)
+
+    def progress(self, n_synced: int, n_new: int):
+        '''
+        Run on_progress when the last n_new of n_synced documents crossed a multiple of progress_every
+        '''
+        if self.on_progress is not None and n_synced // self.progress_every > (n_synced - n_new) // self.progress_every:
+            self.on_progress()
+
+    def sync_documents_by_key(self, keys: Iterable[str], n_keys: int):
+        failed = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for i, (key, future) in enumerate(completed(executor, self.sync_document, keys, self.max_workers * 4), start=1):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed[key] = e
+                    print(f"Failed to sync document {key}: {e}")
+                print(f"Synced {i} of {n_keys} documents ({i/n_keys*100:.2f}%)")
+                self.progress(i, 1)
+        return failed
+
+    def use_bulk_sync(self, keys: List[str], budget: Optional[SyncBudget] = None) -> bool:
+        if len(keys) == 0:
+            return False
+        n_children = self.zotero_client.count_items(CHILD_ITEM_TYPES)
+        listing_requests = math.ceil(n_children / 100)
+        # Children are listed before any document is synced, so a budget the listing would
+        # use up makes no progress in bulk, while fetching documents one by one does
+        requests_left = budget.requests_left() if budget is not None else None
+        if requests_left is not None and listing_requests >= requests_left:
+            return False
+        bulk_requests = math.ceil(len(keys) / 50) + listing_requests
+        return bulk_requests < len(keys) * self.requests_per_document
+
+    def add_document_batches(self, keys: Iterable[str], n_keys: int, children_by_parent):
+        keys = iter(keys)
+        batches = iter(lambda: list(islice(keys, 50)), [])
+        n_synced = 0
+        failed = {}
+        add_batch = partial(self.add_documents, children_by_parent=children_by_parent)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for batch, future in completed(executor, add_batch, batches, self.max_workers * 2):
+                try:
+                    batch_failed = future.result()
+                except Exception as e:
+                    batch_failed = {key: e for key in batch}
+                for key, e in batch_failed.items():
+                    print(f"Failed to sync document {key}: {e}")
+                failed.update(batch_failed)
+                n_synced += len(batch)
+                print(f"Synced {n_synced} of {n_keys} documents ({n_synced/n_keys*100:.2f}%)")
+                self.progress(n_synced, len(batch))
+        return failed
+
+    def changed_keys(self, versions: Dict[str, int], chunk_size: int = 500) -> List[str]:
+        '''
+        Keys whose remote version differs from the local one, comparing chunk_size keys at a time
+        '''
+        items = iter(versions.items())
+        keys = []
+        while True:
+            chunk = list(islice(items, chunk_size))
+            if not chunk:
+                return keys
+            local_versions = self.index.versions_of([key for key, _ in chunk])
+            keys.extend(key for key, version in chunk if local_versions.get(key) != version)
+
+    def read_sync_cursor(self) -> Optional[Tuple[int, Dict[str, int]]]:
+        '''
+        The library version and the key -> version of documents still to sync, in priority
+        order, saved by a run that ran out of budget, failed or was interrupted
+        '''
+        try:
+            with open(f"{self.data_path}/.sync_cursor") as f:
+                cursor = json.load(f)
+        except FileNotFoundError:
+            return None
+        return cursor['library_version'], cursor['versions']
+
+    def write_sync_cursor(self, library_version: int, versions: Dict[str, int]):
+        write_atomic(f"{self.data_path}/.sync_cursor", json.dumps({'library_version': library_version, 'versions': versions}))
+
+    def clear_sync_cursor(self):
+        if os.path.exists(f"{self.data_path}/.sync_cursor"):
+            os.remove(f"{self.data_path}/.sync_cursor")
+
+    def sync_pending(self) -> bool:
+        return os.path.exists(f"{self.data_path}/.sync_cursor")
+
+    def prioritize(self, versions: Dict[str, int], annotated: Set[str]) -> Dict[str, int]:
+        '''
+        Order documents to sync most recently modified first, with priority "annotated"
+        putting documents known to have highlights or notes ahead of the rest
+        '''
+        if self.priority == 'annotated':
+            order = lambda key: (key in annotated, versions[key])
+        else:
+            order = lambda key: versions[key]
+        return {key: versions[key] for key in sorted(versions, key=order, reverse=True)}
+
+    def sync_in_priority_order(self, library_version: int, versions: Dict[str, int], annotated: Set[str],
+                               sync: Callable[[Iterator[str], int], Dict[str, Exception]], budget: SyncBudget):
+        '''
+        Save the cursor, then sync documents in priority order with sync(keys, n_keys) until
+        they run out or the budget is spent. Returns (failed, number of documents not started).
+        '''
+        if self.priority == 'annotated':
+            annotated = annotated | self.index.annotated_keys()
+        versions = self.prioritize(versions, annotated)
+        self.write_sync_cursor(library_version, versions)
+        keys = list(versions)
+        remaining = iter(keys)
+        failed = sync(budget.take(remaining), len(keys))
+        return failed, sum(1 for _ in remaining)
+
+    def sync_budget(self) -> SyncBudget:
+        scheduler = self.zotero_client.scheduler if self.max_requests is not None else None
+        return SyncBudget(self.max_requests, self.max_seconds, scheduler)
+
     def sync_documents(self):
-        versions = self.zotero_client.get_item_versions()
-        n_keys = len(versions)
-        i = 0
-        for key, version in versions.items():
-            try:
-                with open(f"{self.data_path}/{key}.json") as f:
-                    document = Document.parse_raw(f.read())
-                    if document.version != version:
-                        self.update_document(key)
-            except FileNotFoundError:
-                self.add_document(key)
-            #print(f"Synced {i} of {n_keys} documents ({i/n_keys*100:.2f}%)")
-            i += 1
-        
+        '''
+        Sync documents with up to max_workers fetched concurrently. Returns a dict of
+        key -> exception for documents that failed, without aborting the rest of the run.
+
+        After a successful sync the library version is saved as a checkpoint, so the next
+        sync only requests items modified since then and removes items deleted in Zotero.
+        When fetching the changed documents one by one would cost more requests than
+        listing every child item in the library, items are retrieved 50 keys per request
+        and children are listed once for the whole library.
+
+        Documents are synced in priority order within the run's request and time budget.
+        Until every document is synced, the remaining ones are kept in a cursor, so the
+        next run (or a run after an interruption) picks up items changed since the cursor
+        and then carries on where this one stopped, skipping documents already synced.
+        '''
+        since = self.read_library_version()
+        cursor = self.read_sync_cursor()
+        listed_since = cursor[0] if cursor is not None else since
+        versions = self.zotero_client.get_item_versions(listed_since)
+        library_version = self.zotero_client.last_modified_version
+        if cursor is None and since is not None and library_version == since:
+            return {}
+
+        pending = cursor[1] if cursor is not None else {}
+        if listed_since is not None:
+            for key in self.zotero_client.get_deleted_items(listed_since):
+                pending.pop(key, None)
+                if key in self.index:
+                    print(f"Deleting document {key}")
+                    self.report.count('documents_deleted')
+                    self.remove_document(key)
+
+        n_versions = len(versions) + len(pending.keys() - versions.keys())
+        versions.update((key, version) for key, version in pending.items() if key not in versions)
+        del pending
+        keys = self.changed_keys(versions)
+        versions = {key: versions[key] for key in keys}
+
+        budget = self.sync_budget()
+        if self.use_bulk_sync(keys, budget):
+            # Child items are spooled to a temporary database as pages arrive rather than kept in memory
+            with ItemSpool() as children_by_parent:
+                children_by_parent.add(self.zotero_client.iter_all_items(CHILD_ITEM_TYPES))
+                add_batches = partial(self.add_document_batches, children_by_parent=children_by_parent)
+                parents = children_by_parent.annotated_parents() if self.priority == 'annotated' else set()
+                failed, n_unsynced = self.sync_in_priority_order(library_version, versions, parents, add_batches, budget)
+        else:
+            failed, n_unsynced = self.sync_in_priority_order(
+                library_version, versions, set(), self.sync_documents_by_key, budget)
+        self.report.count('documents_skipped', n_versions - len(keys))
+        self.report.count('documents_failed', len(failed))
+        self.report.count('documents_deferred', n_unsynced)
+        self.index.prune_note_blocks()
+        # Documents synced since the last progress callback
+        if self.on_progress is not None and len(keys) > n_unsynced:
+            self.on_progress()
+
+        # Failed and deferred documents stay in the cursor, and the checkpoint is only
+        # moved once nothing is left to sync
+        if not failed and n_unsynced == 0:
+            self.write_library_version(library_version)
+            self.clear_sync_cursor()
+        elif n_unsynced:
+            print(f"Sync budget spent, {n_unsynced} documents left for the next run")
+        return failed
+
     def write_document_page(self, document: ZoteroDocument):
         pass
 
 if __name__ == "__main__":
     load_dotenv()
-    zotero_client = ZoteroClient(os.getenv('ZOTERO_USER_ID'), os.getenv('ZOTERO_API_KEY'))
-    document_client = DocumentClient(zotero_client, os.getenv('DATA_PATH'), os.getenv('GRAPH_PATH'))
-    document_client.sync_documents()
\ No newline at end of file
+    zotero_client = ZoteroClient(os.getenv('ZOTERO_USER_ID'), os.getenv('ZOTERO_API_KEY'), os.getenv('CACHE_PATH'))
+    document_client = DocumentClient(zotero_client, os.getenv('DATA_PATH'), os.getenv('GRAPH_PATH'), int(os.getenv('SYNC_WORKERS', 8)))
+    document_client.sync_documents()
+    print(f"Zotero requests: {zotero_client.scheduler.metrics()}")
\ No newline at end of file
@@ -0,0 +1,549 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+def sanitize(text: str) -> str:
+    return text.replace('/', '_').replace(':', '_')
+
+def page_path(title: str) -> str:
+    return f"pages/{sanitize(title)}.md"
+
+def write_atomic(filename: str, content: str):
+    '''
+    Write a file through a hidden temporary file in the same directory and rename it into
+    place, so readers like Logseq never see a half-written file
+    '''
+    directory, name = os.path.split(filename)
+    tmp_path = os.path.join(directory, f".{name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, filename)
+
+class DocumentIndex:
+    '''
+    SQLite manifest of the document store in DATA_PATH. Each {key}.json has a row with
+    its version, title, page path (relative to GRAPH_PATH), annotation count and content
+    hash, so lookups don't need to parse documents. Rows and JSON files are written and
+    removed inside the same transaction; files added or removed behind the index's back
+    are reconciled when it is opened.
+    '''
+    def __init__(self, data_path: str):
+        self.data_path = data_path
+        self.lock = threading.RLock()
+        self._in_transaction = False
+        self.connection = sqlite3.connect(f"{data_path}/index.sqlite", check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    key TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    title TEXT NOT NULL,
+                    page_path TEXT NOT NULL,
+                    annotation_count INTEGER NOT NULL,
+                    content_hash TEXT NOT NULL
+                )
+            """)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS documents_version ON documents (version)")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS entity_counts (
+                    key TEXT PRIMARY KEY,
+                    content_hash TEXT NOT NULL,
+                    counts TEXT NOT NULL
+                )
+            """)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS page_inputs (
+                    key TEXT PRIMARY KEY,
+                    inputs_hash TEXT NOT NULL
+                )
+            """)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS annotation_days (
+                    day TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    annotation_key TEXT
+                )
+            """)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS annotation_days_day ON annotation_days (day)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS annotation_days_key ON annotation_days (key)")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS keyword_occurrences (
+                    keyword TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    annotation_key TEXT,
+                    type TEXT NOT NULL,
+                    text TEXT NOT NULL
+                )
+            """)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS keyword_occurrences_keyword ON keyword_occurrences (keyword)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS keyword_occurrences_key ON keyword_occurrences (key)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS stale_keywords (keyword TEXT PRIMARY KEY)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS detected_keywords (keyword TEXT PRIMARY KEY)")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS page_files (
+                    key TEXT PRIMARY KEY,
+                    page_path TEXT NOT NULL
+                )
+            """)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS merged_sources (
+                    key TEXT PRIMARY KEY,
+                    page_path TEXT NOT NULL,
+                    sources_hash TEXT NOT NULL
+                )
+            """)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS keyword_pages (
+                    keyword TEXT PRIMARY KEY,
+                    content_hash TEXT NOT NULL
+                )
+            """)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS note_blocks (
+                    key TEXT PRIMARY KEY,
+                    parent TEXT NOT NULL,
+                    cache_key TEXT NOT NULL,
+                    blocks TEXT NOT NULL
+                )
+            """)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS note_blocks_parent ON note_blocks (parent)")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS page_records (
+                    key TEXT PRIMARY KEY,
+                    content_hash TEXT NOT NULL,
+                    record_version INTEGER NOT NULL,
+                    record TEXT NOT NULL
+                )
+            """)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS linked_texts (
+                    key TEXT PRIMARY KEY,
+                    keywords_hash TEXT NOT NULL,
+                    linked TEXT NOT NULL
+                )
+            """)
+        self.reconcile()
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Commit every write made inside the block, by the thread holding it, as one transaction
+        '''
+        with self.lock:
+            if self._in_transaction:
+                yield
+                return
+            self._in_transaction = True
+            try:
+                with self.connection:
+                    yield
+            finally:
+                self._in_transaction = False
+
+    def json_path(self, key: str) -> str:
+        return f"{self.data_path}/{key}.json"
+
+    def _upsert(self, key: str, content: str, fields: Optional[Tuple[int, str, int]] = None,
+                record: Optional[Tuple[int, str]] = None):
+        if fields is None:
+            document = json.loads(content)
+            fields = (document['version'], document['title'], len(document['annotations']) + len(document['notes']))
+        version, title, annotation_count = fields
+        self.connection.execute(
+            """
+            INSERT INTO documents (key, version, title, page_path, annotation_count, content_hash)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET
+                version = excluded.version,
+                title = excluded.title,
+                page_path = excluded.page_path,
+                annotation_count = excluded.annotation_count,
+                content_hash = excluded.content_hash
+            """,
+            (key, version, title, page_path(title), annotation_count, hashlib.sha1(content.encode('utf-8')).hexdigest())
+        )
+        if record is not None:
+            self._set_page_record(key, *record)
+
+    def reconcile(self):
+        '''
+        Index JSON files missing from the index and drop rows whose file is gone
+        '''
+        on_disk = {file[:-len('.json')] for file in os.listdir(self.data_path) if file.endswith('.json')}
+        with self.transaction():
+            indexed = {row['key'] for row in self.connection.execute("SELECT key FROM documents")}
+            for key in on_disk - indexed:
+                with open(self.json_path(key)) as f:
+                    self._upsert(key, f.read())
+            self.connection.executemany("DELETE FROM documents WHERE key = ?",
+                                        [(key,) for key in indexed - on_disk])
+
+    def _write_file(self, key: str, content: str):
+        write_atomic(self.json_path(key), content)
+
+    def write_document(self, key: str, content: str, fields: Optional[Tuple[int, str, int]] = None,
+                       record: Optional[Tuple[int, str]] = None):
+        '''
+        Write a document's JSON and its row. fields is (version, title, annotation_count);
+        callers that already hold the parsed document pass it to skip re-parsing content.
+        record is (record version, page record JSON), stored alongside when given.
+        '''
+        with self.transaction():
+            self._upsert(key, content, fields, record)
+            self._write_file(key, content)
+
+    def write_documents(self, documents: Iterable[Tuple[str, str, Optional[Tuple[int, str, int]], Optional[Tuple[int, str]]]]):
+        '''
+        Write (key, content, fields, record) tuples in a single transaction
+        '''
+        with self.transaction():
+            for key, content, fields, record in documents:
+                self._upsert(key, content, fields, record)
+                self._write_file(key, content)
+
+    def delete_document(self, key: str):
+        '''
+        Remove a document and everything derived from it, except the record of the page file
+        it was rendered to, which stays until the page itself is removed
+        '''
+        with self.transaction():
+            self._mark_keywords_stale(key)
+            self.connection.execute("DELETE FROM keyword_occurrences WHERE key = ?", (key,))
+            self.connection.execute("DELETE FROM documents WHERE key = ?", (key,))
+            self.connection.execute("DELETE FROM entity_counts WHERE key = ?", (key,))
+            self.connection.execute("DELETE FROM page_inputs WHERE key = ?", (key,))
+            self.connection.execute("DELETE FROM annotation_days WHERE key = ?", (key,))
+            self.connection.execute("DELETE FROM merged_sources WHERE key = ?", (key,))
+            self.connection.execute("DELETE FROM page_records WHERE key = ?", (key,))
+            os.remove(self.json_path(key))
+
+    def get(self, key: str) -> Optional[sqlite3.Row]:
+        with self.lock:
+            return self.connection.execute("SELECT * FROM documents WHERE key = ?", (key,)).fetchone()
+
+    def version(self, key: str) -> Optional[int]:
+        row = self.get(key)
+        return row['version'] if row else None
+
+    def page_path(self, key: str) -> Optional[str]:
+        row = self.get(key)
+        return row['page_path'] if row else None
+
+    def page_files(self) -> Dict[str, str]:
+        '''
+        Page file (relative to GRAPH_PATH) each key was last rendered to
+        '''
+        with self.lock:
+            return {row['key']: row['page_path'] for row in self.connection.execute("SELECT key, page_path FROM page_files")}
+
+    def page_file(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute("SELECT page_path FROM page_files WHERE key = ?", (key,)).fetchone()
+        return row['page_path'] if row else None
+
+    def set_page_file(self, key: str, page_path: Optional[str]):
+        with self.transaction():
+            if page_path is None:
+                self.connection.execute("DELETE FROM page_files WHERE key = ?", (key,))
+            else:
+                self.connection.execute("INSERT OR REPLACE INTO page_files (key, page_path) VALUES (?, ?)", (key, page_path))
+
+    def keys(self) -> List[str]:
+        with self.lock:
+            return [row['key'] for row in self.connection.execute("SELECT key FROM documents ORDER BY key")]
+
+    def versions(self) -> Dict[str, int]:
+        with self.lock:
+            return {row['key']: row['version'] for row in self.connection.execute("SELECT key, version FROM documents")}
+
+    def versions_of(self, keys: List[str]) -> Dict[str, int]:
+        '''
+        Local versions of keys, for the ones in the index
+        '''
+        placeholders = ','.join('?' * len(keys))
+        with self.lock:
+            return {row['key']: row['version'] for row in self.connection.execute(
+                f"SELECT key, version FROM documents WHERE key IN ({placeholders})", keys)}
+
+    def annotated_keys(self) -> Set[str]:
+        '''
+        Keys of documents with at least one highlight or note
+        '''
+        with self.lock:
+            return {row['key'] for row in self.connection.execute("SELECT key FROM documents WHERE annotation_count > 0")}
+
+    def changed_since(self, version: int) -> List[str]:
+        with self.lock:
+            return [row['key'] for row in self.connection.execute(
+                "SELECT key FROM documents WHERE version > ? ORDER BY version", (version,))]
+
+    def document_pages(self) -> List[Tuple[str, str, str]]:
+        '''
+        (key, page path, content hash) for every document, ordered by key
+        '''
+        with self.lock:
+            return [tuple(row) for row in self.connection.execute(
+                "SELECT key, page_path, content_hash FROM documents ORDER BY key")]
+
+    def content_hashes(self) -> Dict[str, str]:
+        with self.lock:
+            return {row['key']: row['content_hash'] for row in self.connection.execute("SELECT key, content_hash FROM documents")}
+
+    def entity_counts(self) -> Dict[str, Tuple[str, Dict[str, int]]]:
+        '''
+        Cached named entity counts per document, with the content hash they were computed from
+        '''
+        with self.lock:
+            return {
+                row['key']: (row['content_hash'], json.loads(row['counts']))
+                for row in self.connection.execute("SELECT key, content_hash, counts FROM entity_counts")
+            }
+
+    def iter_entity_counts(self, chunk_size: int = 1000) -> Iterator[Tuple[str, str, Optional[Dict[str, int]]]]:
+        '''
+        Yield (key, content hash, cached entity counts) for every document, with counts None
+        when they are missing or were computed from other content. Rows are read chunk_size
+        at a time so the lock isn't held between chunks.
+        '''
+        last_key = ''
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    """
+                    SELECT d.key, d.content_hash, e.counts FROM documents d
+                    LEFT JOIN entity_counts e ON e.key = d.key AND e.content_hash = d.content_hash
+                    WHERE d.key > ? ORDER BY d.key LIMIT ?
+                    """,
+                    (last_key, chunk_size)
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row['key'], row['content_hash'], json.loads(row['counts']) if row['counts'] is not None else None
+            last_key = rows[-1]['key']
+
+    def set_entity_counts(self, counts: Dict[str, Tuple[str, Dict[str, int]]]):
+        with self.transaction():
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO entity_counts (key, content_hash, counts) VALUES (?, ?, ?)",
+                [(key, content_hash, json.dumps(entities)) for key, (content_hash, entities) in counts.items()]
+            )
+            self.connection.execute("DELETE FROM entity_counts WHERE key NOT IN (SELECT key FROM documents)")
+
+    def page_inputs(self) -> Dict[str, str]:
+        '''
+        Hash of the inputs (document, keywords, template) each page was last rendered from
+        '''
+        with self.lock:
+            return {row['key']: row['inputs_hash'] for row in self.connection.execute("SELECT key, inputs_hash FROM page_inputs")}
+
+    def set_page_inputs(self, key: str, inputs_hash: str):
+        with self.transaction():
+            self.connection.execute("INSERT OR REPLACE INTO page_inputs (key, inputs_hash) VALUES (?, ?)", (key, inputs_hash))
+
+    def set_annotation_days(self, key: str, activity: List[Tuple[str, Optional[str]]]):
+        '''
+        Replace a document's (day, annotation key) rows, day being YYYY-MM-DD
+        '''
+        with self.transaction():
+            self.connection.execute("DELETE FROM annotation_days WHERE key = ?", (key,))
+            self.connection.executemany(
+                "INSERT INTO annotation_days (day, key, annotation_key) VALUES (?, ?, ?)",
+                [(day, key, annotation_key) for day, annotation_key in activity]
+            )
+
+    def annotation_days(self) -> List[str]:
+        '''
+        Days with at least one highlight or note, oldest first
+        '''
+        with self.lock:
+            return [row['day'] for row in self.connection.execute("SELECT DISTINCT day FROM annotation_days ORDER BY day")]
+
+    def annotations_on(self, day: str) -> List[Tuple[str, Optional[str]]]:
+        '''
+        (document key, annotation key) for every highlight and note made on day
+        '''
+        with self.lock:
+            return [(row['key'], row['annotation_key']) for row in self.connection.execute(
+                "SELECT key, annotation_key FROM annotation_days WHERE day = ? ORDER BY key", (day,))]
+
+    def _mark_keywords_stale(self, key: str, keywords: Iterable[str] = ()):
+        self.connection.execute(
+            "INSERT OR IGNORE INTO stale_keywords (keyword) SELECT DISTINCT keyword FROM keyword_occurrences WHERE key = ?",
+            (key,)
+        )
+        self.connection.executemany("INSERT OR IGNORE INTO stale_keywords (keyword) VALUES (?)", [(k,) for k in keywords])
+
+    def set_keyword_occurrences(self, key: str, occurrences: List[Tuple[str, int, Optional[str], str, str]]):
+        '''
+        Replace a document's (keyword, position, annotation key, type, linked text) rows.
+        Keywords it mentioned before or mentions now are marked stale.
+        '''
+        with self.transaction():
+            self._mark_keywords_stale(key, {occurrence[0] for occurrence in occurrences})
+            self.connection.execute("DELETE FROM keyword_occurrences WHERE key = ?", (key,))
+            self.connection.executemany(
+                "INSERT INTO keyword_occurrences (keyword, key, position, annotation_key, type, text) VALUES (?, ?, ?, ?, ?, ?)",
+                [(keyword, key, *occurrence) for keyword, *occurrence in occurrences]
+            )
+
+    def keyword_occurrences(self, keyword: str) -> List[sqlite3.Row]:
+        '''
+        Occurrences of keyword with their document's title, ordered by title and position
+        '''
+        with self.lock:
+            return self.connection.execute(
+                """
+                SELECT o.key, o.annotation_key, o.type, o.text, d.title, d.page_path
+                FROM keyword_occurrences o JOIN documents d ON d.key = o.key
+                WHERE o.keyword = ?
+                ORDER BY d.title, o.key, o.position
+                """,
+                (keyword,)
+            ).fetchall()
+
+    def saved_keywords(self) -> List[str]:
+        with self.lock:
+            return [row['keyword'] for row in self.connection.execute("SELECT keyword FROM detected_keywords ORDER BY keyword")]
+
+    def save_keywords(self, keywords: Iterable[str]):
+        '''
+        Replace the keywords found by the last keyword detection
+        '''
+        with self.transaction():
+            self.connection.execute("DELETE FROM detected_keywords")
+            self.connection.executemany("INSERT INTO detected_keywords (keyword) VALUES (?)", [(k,) for k in keywords])
+
+    def stale_keywords(self) -> List[str]:
+        with self.lock:
+            return [row['keyword'] for row in self.connection.execute("SELECT keyword FROM stale_keywords ORDER BY keyword")]
+
+    def keyword_pages(self) -> Dict[str, str]:
+        '''
+        Keyword pages written so far, with the hash of their content
+        '''
+        with self.lock:
+            return {row['keyword']: row['content_hash'] for row in self.connection.execute("SELECT keyword, content_hash FROM keyword_pages")}
+
+    def set_keyword_page(self, keyword: str, content_hash: Optional[str]):
+        '''
+        Record a written keyword page, or its removal when content_hash is None, and clear its stale flag
+        '''
+        with self.transaction():
+            if content_hash is None:
+                self.connection.execute("DELETE FROM keyword_pages WHERE keyword = ?", (keyword,))
+            else:
+                self.connection.execute("INSERT OR REPLACE INTO keyword_pages (keyword, content_hash) VALUES (?, ?)",
+                                        (keyword, content_hash))
+            self.connection.execute("DELETE FROM stale_keywords WHERE keyword = ?", (keyword,))
+
+    def document_page_paths(self) -> Set[str]:
+        with self.lock:
+            return {row['page_path'] for row in self.connection.execute("SELECT page_path FROM documents")}
+
+    def merged_sources(self) -> Dict[str, Tuple[str, str]]:
+        '''
+        For documents merged from several libraries, key -> (page path, hash of the source documents)
+        '''
+        with self.lock:
+            return {row['key']: (row['page_path'], row['sources_hash'])
+                    for row in self.connection.execute("SELECT key, page_path, sources_hash FROM merged_sources")}
+
+    def set_merged_source(self, key: str, page_path: str, sources_hash: str):
+        with self.transaction():
+            self.connection.execute("INSERT OR REPLACE INTO merged_sources (key, page_path, sources_hash) VALUES (?, ?, ?)",
+                                    (key, page_path, sources_hash))
+
+    def note_blocks(self, keys: List[str]) -> Dict[str, Tuple[str, List[str]]]:
+        '''
+        Blocks child notes were split into, note key -> (cache key, blocks), for the given note keys
+        '''
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT key, cache_key, blocks FROM note_blocks WHERE key IN ({','.join('?' * len(keys))})", keys
+            ).fetchall()
+        return {row['key']: (row['cache_key'], json.loads(row['blocks'])) for row in rows}
+
+    def set_note_blocks(self, parent: str, blocks: Dict[str, Tuple[str, List[str]]]):
+        '''
+        Replace the cached blocks of a document's child notes, dropping notes it no longer has
+        '''
+        with self.transaction():
+            self.connection.execute("DELETE FROM note_blocks WHERE parent = ?", (parent,))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO note_blocks (key, parent, cache_key, blocks) VALUES (?, ?, ?, ?)",
+                [(key, parent, cache_key, json.dumps(note_blocks)) for key, (cache_key, note_blocks) in blocks.items()]
+            )
+
+    def prune_note_blocks(self):
+        '''
+        Drop cached blocks of notes whose document is gone. Run once a sync has finished,
+        so documents being added aren't mistaken for deleted ones.
+        '''
+        with self.transaction():
+            self.connection.execute("DELETE FROM note_blocks WHERE parent NOT IN (SELECT key FROM documents)")
+
+    def _set_page_record(self, key: str, record_version: int, record: str):
+        # Stamped with the document's current content hash, so a record is only used for the content it was built from
+        self.connection.execute(
+            """
+            INSERT OR REPLACE INTO page_records (key, content_hash, record_version, record)
+            SELECT key, content_hash, ?, ? FROM documents WHERE key = ?
+            """,
+            (record_version, record, key)
+        )
+
+    def set_page_record(self, key: str, record_version: int, record: str):
+        with self.transaction():
+            self._set_page_record(key, record_version, record)
+
+    def page_records(self, keys: List[str], record_version: int) -> Dict[str, str]:
+        '''
+        Page record JSON for the given keys, leaving out records built from other content or
+        by another record version
+        '''
+        with self.lock:
+            rows = self.connection.execute(
+                f"""
+                SELECT r.key, r.record FROM page_records r JOIN documents d ON d.key = r.key
+                WHERE r.content_hash = d.content_hash AND r.record_version = ?
+                AND r.key IN ({','.join('?' * len(keys))})
+                """,
+                [record_version, *keys]
+            ).fetchall()
+        return {row['key']: row['record'] for row in rows}
+
+    def linked_texts(self, keys: List[str], keywords_hash: str) -> Dict[str, Dict[str, Tuple[str, List[str]]]]:
+        '''
+        Keyword-linked texts of the given documents, key -> text -> (linked text, keywords),
+        for documents last linked with the keyword set hashing to keywords_hash
+        '''
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT key, linked FROM linked_texts WHERE keywords_hash = ? AND key IN ({','.join('?' * len(keys))})",
+                [keywords_hash, *keys]
+            ).fetchall()
+        return {row['key']: json.loads(row['linked']) for row in rows}
+
+    def set_linked_texts(self, key: str, keywords_hash: str, linked: Dict[str, Tuple[str, List[str]]]):
+        with self.transaction():
+            self.connection.execute("INSERT OR REPLACE INTO linked_texts (key, keywords_hash, linked) VALUES (?, ?, ?)",
+                                    (key, keywords_hash, json.dumps(linked)))
+
+    def prune_linked_texts(self):
+        '''
+        Drop linked texts of deleted documents. They are keyed by text, so a document that
+        changed keeps the links of its unchanged texts.
+        '''
+        with self.transaction():
+            self.connection.execute("DELETE FROM linked_texts WHERE key NOT IN (SELECT key FROM documents)")
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
@@ -0,0 +1,148 @@
+import gzip
+from datetime import datetime
+from functools import lru_cache
+from pydantic import BaseModel
+from document_index import DocumentIndex
+from typing import IO, Iterable, Iterator, Optional
+
+# Bump when page_record() builds different records from the same document, so they are rebuilt
+PAGE_RECORD_VERSION = 1
+
+class DocumentHighlight(BaseModel):
+    text: str
+    mtime: str
+    key: Optional[str] = None
+
+class DocumentNote(BaseModel):
+    text: str
+    mtime: str
+    key: Optional[str] = None
+
+class Document(BaseModel):
+    key: str
+    version: int
+    title: str
+    abstract: Optional[str]
+    collections: list[str]
+    annotations: list[DocumentHighlight]
+    notes: list[DocumentNote]
+
+class Annotation(BaseModel):
+    type: str
+    text: str
+    mtime: str
+    key: Optional[str] = None
+    day: Optional[str] = None
+
+class PageRecord(BaseModel):
+    '''
+    What a document page is rendered from: the document's key and abstract, and its notes
+    and highlights sorted by mtime with their mtime already formatted for the page
+    '''
+    key: str
+    abstract: Optional[str]
+    annotations: list[Annotation]
+
+def get_ordinal_suffix(day: int) -> str:
+    if 11 <= day <= 13:
+        return 'th'
+    else:
+        return {1: 'st', 2: 'nd', 3: 'rd'}.get(day % 10, 'th')
+
+@lru_cache(maxsize=4096)
+def format_day(day: str) -> str:
+    '''
+    Format a YYYY-MM-DD day the way Logseq shows journal dates, e.g. Mar 2nd, 2024
+    '''
+    dt = datetime.strptime(day, '%Y-%m-%d')
+    return dt.strftime(f'%b {dt.day}{get_ordinal_suffix(dt.day)}, %Y')
+
+def page_record(document: Document) -> PageRecord:
+    annotations = sorted(document.notes + document.annotations, key=lambda x: x.mtime)
+    return PageRecord(key=document.key, abstract=document.abstract, annotations=[
+        Annotation(type='note' if isinstance(annotation, DocumentNote) else 'highlight', text=annotation.text,
+                   mtime=format_day(annotation.mtime[:10]), key=annotation.key, day=annotation.mtime[:10])
+        for annotation in annotations
+    ])
+
+def load_document(path: str) -> Document:
+    with open(path, 'rb') as f:
+        return Document.model_validate_json(f.read())
+
+def dump_document(document: Document) -> str:
+    return document.model_dump_json()
+
+def index_fields(document: Document):
+    return document.version, document.title, len(document.annotations) + len(document.notes)
+
+def dump_page_record(document: Document):
+    return PAGE_RECORD_VERSION, page_record(document).model_dump_json()
+
+def open_jsonl(path: str, mode: str) -> IO[bytes]:
+    return gzip.open(path, mode) if path.endswith('.gz') else open(path, mode)
+
+class DocumentStore:
+    '''
+    Loads and saves Documents in DATA_PATH, one {key}.json each, through pydantic's
+    JSON-native validation and serialization with no intermediate dicts. Each save also
+    stores the document's PageRecord in the index, so pages render without sorting or
+    formatting dates again. The whole library can also be exported to, and imported
+    from, a single JSON Lines file (gzipped when the path ends in .gz) for backups and
+    moving between machines.
+    '''
+    def __init__(self, data_path: str, index: Optional[DocumentIndex] = None):
+        self.data_path = data_path
+        self.index = index or DocumentIndex(data_path)
+
+    def path(self, key: str) -> str:
+        return self.index.json_path(key)
+
+    def load(self, key: str) -> Document:
+        return load_document(self.path(key))
+
+    def load_many(self, keys: Iterable[str]) -> Iterator[Document]:
+        for key in keys:
+            yield self.load(key)
+
+    def save(self, document: Document):
+        self.index.write_document(document.key, dump_document(document), index_fields(document),
+                                  dump_page_record(document))
+
+    def save_many(self, documents: Iterable[Document]):
+        self.index.write_documents(
+            (document.key, dump_document(document), index_fields(document), dump_page_record(document))
+            for document in documents
+        )
+
+    def delete(self, key: str):
+        self.index.delete_document(key)
+
+    def export_jsonl(self, path: str) -> int:
+        '''
+        Write every document as one line of path, copying the stored JSON verbatim
+        '''
+        n = 0
+        with open_jsonl(path, 'wb') as out:
+            for key in self.index.keys():
+                with open(self.path(key), 'rb') as f:
+                    out.write(f.read().rstrip(b'\n'))
+                out.write(b'\n')
+                n += 1
+        return n
+
+    def import_jsonl(self, path: str, batch_size: int = 1000) -> int:
+        '''
+        Validate and save every document in path, committing batch_size documents per transaction
+        '''
+        n = 0
+        batch = []
+        with open_jsonl(path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    batch.append(Document.model_validate_json(line))
+                if len(batch) >= batch_size:
+                    self.save_many(batch)
+                    n += len(batch)
+                    batch = []
+        self.save_many(batch)
+        return n + len(batch)
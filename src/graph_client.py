@@ -1,102 +1,345 @@
 import os
-import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 from jinja2 import Environment, FileSystemLoader
-from typing import Any
-from document_client import Document, DocumentNote
+from document_index import sanitize, write_atomic
+from document_store import (
+    PAGE_RECORD_VERSION,
+    Annotation,
+    Document,
+    DocumentStore,
+    PageRecord,
+    format_day,
+    get_ordinal_suffix,
+    load_document,
+    page_record
+)
 from keyword_client import KeywordClient
-from pydantic import BaseModel
-from typing import List
+from keyword_matcher import KeywordMatcher
+from run_report import RunReport
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
 
-class Annotation(BaseModel):
-    type: str
-    text: str
-    mtime: str
+# Bump when rendering produces different outputs for unchanged inputs, so every page is re-rendered once
+RENDER_VERSION = 4
 
-def get_ordinal_suffix(day: int) -> str:
-    if 11 <= day <= 13:
-        return 'th'
-    else:
-        return {1: 'st', 2: 'nd', 3: 'rd'}.get(day % 10, 'th')
+class RenderedPage(NamedTuple):
+    '''
+    A rendered document page (None if it has no annotations), with the (day, annotation
+    key) activity for the journal index, the (keyword, position, annotation key, type,
+    linked text) occurrences for the keyword index, the page record JSON if it had to be
+    built from the document, and the text -> (linked text, keywords) links of the page
+    '''
+    content: Optional[str]
+    activity: List[Tuple[str, Optional[str]]]
+    occurrences: List[Tuple[str, int, Optional[str], str, str]]
+    record: Optional[str] = None
+    linked: Dict[str, Tuple[str, List[str]]] = {}
+
+def get_document_annotations(document: Document) -> List[Annotation]:
+    return page_record(document).annotations
+
+class PageRenderer:
+    '''
+    Renders document pages from the page records stored at sync time with a compiled
+    template and keyword matcher, reusing keyword links made with the same keyword set.
+    Documents without an up to date record are loaded from the JSON store instead. It holds
+    no open files or connections, and compiled templates can't be pickled, so it sends only
+    the template source to worker processes and each process compiles it once.
+    '''
+    def __init__(self, data_path: str, template_source: str, matcher: KeywordMatcher):
+        self.data_path = data_path
+        self.template_source = template_source
+        self.matcher = matcher
+        self._template = None
+
+    @property
+    def template(self):
+        if self._template is None:
+            self._template = Environment().from_string(self.template_source)
+        return self._template
+
+    def __getstate__(self):
+        return {**self.__dict__, '_template': None}
+
+    def render(self, key: str) -> Optional[str]:
+        '''
+        Render the page for a document, or None if it has no annotations
+        '''
+        return self.render_page(key).content
+
+    def render_page(self, key: str, record: Optional[str] = None,
+                    linked: Optional[Dict[str, Tuple[str, List[str]]]] = None) -> RenderedPage:
+        '''
+        Render the page for a document from its page record JSON, collecting its annotation
+        activity and keyword occurrences in the same pass. linked holds keyword links
+        already made for the document's texts with the matcher's keywords.
+        '''
+        built = None
+        if record is None:
+            page = page_record(load_document(f"{self.data_path}/{key}.json"))
+            built = page.model_dump_json()
+        else:
+            page = PageRecord.model_validate_json(record)
+        activity = [(annotation.day, annotation.key) for annotation in page.annotations]
+        if len(page.annotations) == 0:
+            return RenderedPage(None, activity, [], built)
+
+        cached = linked or {}
+        links = {}
+        def link(text: str) -> Tuple[str, List[str]]:
+            if text not in links:
+                links[text] = cached[text] if text in cached else self.matcher.link_keywords(text)
+            return links[text]
+
+        if page.abstract is not None:
+            page.abstract = link(page.abstract)[0]
+        occurrences = []
+        for position, annotation in enumerate(page.annotations):
+            annotation.text, keywords = link(annotation.text)
+            occurrences.extend(
+                (keyword, position, annotation.key, annotation.type, annotation.text) for keyword in keywords
+            )
+
+        content = self.template.render(document=page, annotations=page.annotations)
+        return RenderedPage(content, activity, occurrences, built, links)
+
+_worker_renderer = None
+
+def _init_render_worker(renderer: PageRenderer):
+    global _worker_renderer
+    _worker_renderer = renderer
+
+def _render_in_worker(job: Tuple[str, Optional[str], Optional[dict]]):
+    key, record, linked = job
+    return key, _worker_renderer.render_page(key, record, linked)
 
 class GraphClient:
-    def __init__(self, data_path: str, graph_path: str, template_path: str, keyword_client: KeywordClient):
+    def __init__(self, data_path: str, graph_path: str, template_path: str, keyword_client: Optional[KeywordClient], processes: int = 1,
+                 report: Optional[RunReport] = None, mp_context=None):
         self.data_path = data_path
+        self.report = report or RunReport()
         self.graph_path = graph_path
         self.keyword_client = keyword_client
+        self.processes = processes
+        # multiprocessing context of the render pool, the platform's default start method when None
+        self.mp_context = mp_context
+        self.store = DocumentStore(data_path)
+        self.index = self.store.index
         self.env = Environment(loader=FileSystemLoader(template_path))
 
     def sanitize(self, text: str) -> str:
-        return text.replace('/', '_').replace(':', '_')
+        return sanitize(text)
 
     def get_document_annotations(self, document: Document) -> List[Annotation]:
-        annotations = sorted(document.notes + document.annotations, key=lambda x: x.mtime)
-        for i, annotation in enumerate(annotations):
-            dt = datetime.strptime(annotation.mtime, '%Y-%m-%dT%H:%M:%SZ')
-            day = dt.day
-            ordinal_suffix = get_ordinal_suffix(day)
-            annotations[i].mtime = dt.strftime(f'%b {day}{ordinal_suffix}, %Y')
-            if type(annotation) == DocumentNote:
-                annotations[i] = Annotation(type='note', text=annotation.text, mtime=annotation.mtime)
-            else:
-                annotations[i] = Annotation(type='highlight', text=annotation.text, mtime=annotation.mtime)
-        return annotations
+        return get_document_annotations(document)
+
+    @property
+    def template_source(self) -> str:
+        source, _, _ = self.env.loader.get_source(self.env, 'document_page_template.md')
+        return source
+
+    @property
+    def template_hash(self) -> str:
+        return hashlib.sha1(self.template_source.encode('utf-8')).hexdigest()
+
+    def renderer(self) -> PageRenderer:
+        return PageRenderer(self.data_path, self.template_source, self.keyword_client.matcher)
+
+    def render_document_page(self, key: str) -> Optional[str]:
+        return self.renderer().render(key)
 
-    def write_document_page(self, key: str):
-        with open(f"{self.data_path}/{key}.json") as file:
-            document = Document.parse_obj(json.load(file))
+    def write_page(self, filename: str, content: str) -> bool:
+        '''
+        Write a page atomically unless the file already has exactly this content
+        '''
+        try:
+            with open(filename) as file:
+                if file.read() == content:
+                    return False
+        except FileNotFoundError:
+            pass
+        write_atomic(filename, content)
+        return True
 
-        document.abstract = self.keyword_client.highlight_keywords(document.abstract)
+    def move_page(self, previous: str, target: str):
+        '''
+        Rename a document's page after its title changed, unless another document's page
+        now lives at the old path or a page already exists at the new one
+        '''
+        old, new = f"{self.graph_path}/{previous}", f"{self.graph_path}/{target}"
+        if not os.path.exists(old) or previous in self.index.document_page_paths():
+            return
+        if os.path.exists(new):
+            os.remove(old)
+            self.report.count('pages_removed')
+        else:
+            os.replace(old, new)
+            self.report.count('pages_renamed')
 
-        template = self.env.get_template('document_page_template.md')
-        annotations = self.get_document_annotations(document)
+    def place_page(self, key: str, content: str) -> bool:
+        '''
+        Write a document's page, moving the page it was last rendered to first if its title
+        changed, and record the page file for the key. Returns whether the file was written.
+        '''
+        target = self.index.page_path(key)
+        previous = self.index.page_file(key)
+        if previous is not None and previous != target:
+            self.move_page(previous, target)
+        written = self.write_page(f"{self.graph_path}/{target}", content)
+        self.index.set_page_file(key, target)
+        return written
 
-        for annotation in annotations:
-            annotation.text = self.keyword_client.highlight_keywords(annotation.text)
+    def write_document_page(self, key: str) -> bool:
+        page_content = self.render_document_page(key)
+        if page_content is None:
+            return False
+        return self.place_page(key, page_content)
 
-        page_content = template.render(document=document, annotations=annotations)
+    def render_jobs(self, keys: List[str], keywords_hash: str) -> Iterator[Tuple[str, Optional[str], Optional[dict]]]:
+        '''
+        (key, page record JSON, linked texts) for keys, None where nothing is stored yet
+        '''
+        records = self.index.page_records(keys, PAGE_RECORD_VERSION)
+        linked = self.index.linked_texts(keys, keywords_hash)
+        for key in keys:
+            yield key, records.get(key), linked.get(key)
+
+    def render_pages(self, keys: List[str], chunk_size: int = 500):
+        '''
+        Yield (key, RenderedPage) for keys, split across a process pool when processes > 1.
+        The renderer (template and keyword matcher) is sent to each worker once, and page
+        records are read from the index chunk_size keys at a time.
+        '''
+        renderer = self.renderer()
+        keywords_hash = self.keyword_client.keywords_hash
+        chunks = (keys[i:i + chunk_size] for i in range(0, len(keys), chunk_size))
+        if self.processes <= 1 or len(keys) <= 1:
+            for chunk in chunks:
+                for key, record, linked in self.render_jobs(chunk, keywords_hash):
+                    yield key, renderer.render_page(key, record, linked)
+            return
+        chunksize = max(1, min(len(keys), chunk_size) // (self.processes * 4))
+        with ProcessPoolExecutor(max_workers=self.processes, mp_context=self.mp_context, initializer=_init_render_worker,
+                                 initargs=(renderer,)) as executor:
+            for chunk in chunks:
+                yield from executor.map(_render_in_worker, self.render_jobs(chunk, keywords_hash), chunksize=chunksize)
 
-        if len(annotations) > 0:           
-            filename = f"{self.graph_path}/pages/{self.sanitize(document.title)}.md"
-            with open(filename, 'w') as file:
-                file.write(page_content)
-        
     def delete_document_page(self, key: str):
-        with open(f"{self.data_path}/{key}.json") as file:
-            document = Document.parse_obj(json.load(file))
-        
-        filename = f"{self.graph_path}/pages/{self.sanitize(document.title)}.md"
+        filename = f"{self.graph_path}/{self.index.page_file(key) or self.index.page_path(key)}"
         os.remove(filename)
+        self.index.set_page_file(key, None)
+
+    def collect_orphan_pages(self) -> int:
+        '''
+        Remove pages of deleted documents and move pages of retitled ones, from a single
+        listing of the pages directory and the key -> page file map. Returns the number of
+        pages removed or moved.
+        '''
+        existing = set(os.listdir(f"{self.graph_path}/pages"))
+        current = {key: page_path for key, page_path, _ in self.index.document_pages()}
+        in_use = set(current.values())
+        n_collected = 0
+        for key, page_path in self.index.page_files().items():
+            target = current.get(key)
+            if target == page_path:
+                continue
+            name = os.path.basename(page_path)
+            if name in existing and page_path not in in_use:
+                if target is not None and os.path.basename(target) not in existing:
+                    os.replace(f"{self.graph_path}/{page_path}", f"{self.graph_path}/{target}")
+                    existing.add(os.path.basename(target))
+                    self.report.count('pages_renamed')
+                else:
+                    os.remove(f"{self.graph_path}/{page_path}")
+                    self.report.count('pages_removed')
+                existing.discard(name)
+                n_collected += 1
+            self.index.set_page_file(key, target)
+        return n_collected
+
+    def journal_filename(self, day: str) -> str:
+        return f"{day.replace('-', '_')}.md"
 
-    def write_journal_page(self, date: datetime):
-        dt = datetime.strptime(date, '%Y-%m-%dT%H:%M:%SZ')
-        day = dt.day
-        ordinal_suffix = get_ordinal_suffix(day)
-        format_dt = dt.strftime(f'%b {day}{ordinal_suffix}, %Y')
-        fn_dt = dt.strftime(f'%Y_%m_%d')
-        content = f"{{{{query (and (property mtime <% {format_dt} %>))}}}}"
-        if not os.path.exists(f"{self.graph_path}/journals/{fn_dt}.md"):
-            with open(f"{self.graph_path}/journals/{fn_dt}.md", 'w') as file:
-                file.write(content)
+    def write_journal_page(self, day: str):
+        '''
+        Write the journal page for a YYYY-MM-DD day with a query for that day's notes and highlights
+        '''
+        content = f"{{{{query (and (property mtime <% {format_day(day)} %>))}}}}"
+        write_atomic(f"{self.graph_path}/journals/{self.journal_filename(day)}", content)
     
-    def sync_graph(self):
-        for file in os.listdir(self.data_path):
-            if file.endswith('.json'):
-                key = file.replace('.json', '')
-                self.write_document_page(key)
-
-    def backfill_journal_pages(self, n_days=90):
-        date_now = datetime.now()
-        past_3_months = [date_now - timedelta(days=x) for x in range(n_days)]
-        past_3_months = [date.strftime('%Y-%m-%dT%H:%M:%SZ') for date in past_3_months]
-        for date in past_3_months:
-            self.write_journal_page(date)
+    def sync_graph(self, collect_orphans: bool = True, chunk_size: int = 500):
+        '''
+        Render pages whose document, keyword set or template changed since they were last
+        rendered, then collect pages left behind by deleted or retitled documents unless
+        collect_orphans is False, as while a sync is still updating documents. Returns the
+        number of page files written.
+        '''
+        inputs_hash_prefix = f"{self.keyword_client.keywords_hash}:{self.template_hash}:{RENDER_VERSION}"
+        rendered_inputs = self.index.page_inputs()
+        stale = {}
+        for key, content_hash in self.index.content_hashes().items():
+            inputs_hash = hashlib.sha1(f"{content_hash}:{inputs_hash_prefix}".encode('utf-8')).hexdigest()
+            if rendered_inputs.get(key) != inputs_hash:
+                stale[key] = inputs_hash
+            else:
+                self.report.count('pages_skipped')
+
+        # Pages are written by this process only, as rendered pages come back from the workers,
+        # and the index is updated for chunk_size pages per transaction
+        keywords_hash = self.keyword_client.keywords_hash
+        pages = self.render_pages(list(stale), chunk_size)
+        n_written = 0
+        while True:
+            chunk = list(islice(pages, chunk_size))
+            if not chunk:
+                break
+            with self.index.transaction():
+                for key, page in chunk:
+                    if page.record is not None:
+                        self.index.set_page_record(key, PAGE_RECORD_VERSION, page.record)
+                        self.report.count('page_records_built')
+                    self.index.set_linked_texts(key, keywords_hash, page.linked)
+                    self.index.set_annotation_days(key, page.activity)
+                    self.index.set_keyword_occurrences(key, page.occurrences)
+                    if page.content is None:
+                        self.report.count('pages_empty')
+                    elif self.place_page(key, page.content):
+                        self.report.count('pages_written')
+                        n_written += 1
+                    else:
+                        self.report.count('pages_unchanged')
+                    self.index.set_page_inputs(key, stale[key])
+        if collect_orphans:
+            self.index.prune_linked_texts()
+            self.collect_orphan_pages()
+        return n_written
+
+    def backfill_journal_pages(self, n_days: Optional[int] = None) -> int:
+        '''
+        Write a journal page for every day with annotation activity that doesn't have one,
+        limited to the last n_days when given. Activity comes from the index sync_graph
+        builds while rendering. Returns the number of journal pages written.
+        '''
+        days = self.index.annotation_days()
+        if n_days is not None:
+            first_day = (datetime.now() - timedelta(days=n_days - 1)).strftime('%Y-%m-%d')
+            days = [day for day in days if day >= first_day]
+        existing = set(os.listdir(f"{self.graph_path}/journals"))
+        n_written = 0
+        for day in days:
+            if self.journal_filename(day) not in existing:
+                self.write_journal_page(day)
+                n_written += 1
+        self.report.count('journal_pages_written', n_written)
+        return n_written
 
 if __name__ == "__main__":
-    # Backfill journal pages for the past 3 months with a query for notes and highlights
+    # Render changed pages and write journal pages for days with notes and highlights
     load_dotenv()
     keyword_client = KeywordClient(os.getenv('DATA_PATH'), os.getenv('KEYWORD_PATH'))
-    gc = GraphClient(os.getenv('DATA_PATH'), os.getenv('GRAPH_PATH'), os.getenv('TEMPLATE_PATH'), keyword_client)
+    gc = GraphClient(os.getenv('DATA_PATH'), os.getenv('GRAPH_PATH'), os.getenv('TEMPLATE_PATH'), keyword_client, int(os.getenv('RENDER_PROCESSES', 1)))
     gc.sync_graph()
     gc.backfill_journal_pages()
\ No newline at end of file
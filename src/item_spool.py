@@ -0,0 +1,71 @@
+import json
+import sqlite3
+import threading
+from typing import Iterable, List, Set
+
+class ItemSpool:
+    '''
+    Temporary on-disk store of Zotero items grouped by their parentItem, so a bulk sync can
+    page through every child item in the library without holding them all in memory.
+    Lookups mirror dict.get, so a spool can stand in for a dict of parent key -> items.
+    The database is private to the spool and removed when it is closed.
+    '''
+    def __init__(self, chunk_size: int = 1000):
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        # An empty filename is a private temporary database that SQLite spills to disk
+        self.connection = sqlite3.connect('', check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE items (parent TEXT NOT NULL, key TEXT NOT NULL, item_type TEXT NOT NULL, item TEXT NOT NULL)")
+            self.connection.execute("CREATE INDEX items_parent ON items (parent)")
+
+    def add(self, items: Iterable[dict]) -> int:
+        '''
+        Store items that have a parentItem, chunk_size rows per transaction. Returns the number stored.
+        '''
+        n = 0
+        rows = []
+        for item in items:
+            parent_key = item['data'].get('parentItem')
+            if parent_key:
+                rows.append((parent_key, item['key'], item['data'].get('itemType', ''), json.dumps(item)))
+            if len(rows) >= self.chunk_size:
+                n += self._insert(rows)
+                rows = []
+        return n + self._insert(rows)
+
+    def _insert(self, rows) -> int:
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT INTO items (parent, key, item_type, item) VALUES (?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def get(self, parent_key: str, default=None) -> List[dict]:
+        with self.lock:
+            rows = self.connection.execute("SELECT item FROM items WHERE parent = ? ORDER BY rowid", (parent_key,)).fetchall()
+        if not rows:
+            return default
+        return [json.loads(item) for item, in rows]
+
+    def annotated_parents(self) -> Set[str]:
+        '''
+        Keys of items with child notes or with an attachment that has annotations
+        '''
+        with self.lock:
+            rows = self.connection.execute("""
+                SELECT parent FROM items WHERE item_type = 'note'
+                UNION
+                SELECT attachment.parent FROM items attachment
+                JOIN items annotation ON annotation.parent = attachment.key
+                WHERE attachment.item_type = 'attachment' AND annotation.item_type = 'annotation'
+            """).fetchall()
+        return {parent for parent, in rows}
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
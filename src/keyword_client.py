@@ -1,36 +1,85 @@
 import os
-import re
-import spacy
+import time
+import hashlib
 from dotenv import load_dotenv
-import json
 from collections import Counter
-from itertools import chain
-from document_client import Document
+from document_index import page_path, write_atomic
+from document_store import DocumentStore
+from keyword_matcher import KeywordMatcher
+from run_report import RunReport
+from typing import Iterator, List, Optional, Tuple
 
 class KeywordClient:
 
-    def __init__(self, data_path: str, keywords: list = []):
+    def __init__(self, data_path: str, keywords: list = [], n_process: int = 1, batch_size: int = 256,
+                 report: Optional[RunReport] = None, chunk_size: int = 500, detect: bool = True):
         self.data_path = data_path
+        self.report = report or RunReport()
+        self.store = DocumentStore(data_path)
+        self.index = self.store.index
+        self.n_process = n_process
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self._nlp = None
 
         if keywords:
             self.keywords = keywords
-        else:
+        elif detect:
             self.keywords = self.detect_keywords()
+        else:
+            # Keywords of the last detection, without running the pipeline
+            self.keywords = self.index.saved_keywords()
+        self.matcher = KeywordMatcher(self.keywords)
+
+    @property
+    def nlp(self):
+        # Only the entity recognizer (and the tok2vec layer it may listen to) is needed
+        if self._nlp is None:
+            import spacy
+            self._nlp = spacy.load("en_core_web_sm", exclude=["tagger", "parser", "attribute_ruler", "lemmatizer"])
+        return self._nlp
     
     def extract_named_entities(self, corpus):
-        nlp = spacy.load("en_core_web_sm")
-        all_entities = []
-        for doc_text in corpus:
-            doc = nlp(doc_text)
-            for ent in doc.ents:
-                all_entities.append(ent.text.strip())
-        
-        return Counter(all_entities)
+        counts = Counter()
+        for doc in self.nlp.pipe(corpus, batch_size=self.batch_size, n_process=self.n_process):
+            counts.update(ent.text.strip() for ent in doc.ents)
+        return counts
+
+    def extract_document_entities(self, keys: List[str]) -> Iterator[Tuple[str, Counter]]:
+        '''
+        Yield (key, named entity counts) for each document in keys order. The text of all
+        documents streams through one nlp.pipe, which keeps input order, so a document's
+        counts are complete once texts of the next document arrive.
+        '''
+        texts = ((text, key) for key in keys for text in self.document_to_corpus(key))
+        remaining = iter(keys)
+        current, counts = None, Counter()
+        n_texts = 0
+        start = time.perf_counter()
+        for doc, key in self.nlp.pipe(texts, as_tuples=True, batch_size=self.batch_size, n_process=self.n_process):
+            n_texts += 1
+            if key != current:
+                if current is not None:
+                    yield current, counts
+                # Documents with no text never come out of the pipe
+                for skipped in remaining:
+                    if skipped == key:
+                        break
+                    yield skipped, Counter()
+                current, counts = key, Counter()
+            counts.update(ent.text.strip() for ent in doc.ents)
+        if current is not None:
+            yield current, counts
+        for skipped in remaining:
+            yield skipped, Counter()
+        seconds = time.perf_counter() - start
+        self.report.count('ner_documents', len(keys))
+        self.report.count('ner_texts', n_texts)
+        self.report.set('ner_texts_per_second', round(n_texts / seconds, 1) if seconds > 0 else None)
 
     def document_to_corpus(self, key):
-        with open(f"{self.data_path}/{key}.json") as file:
-            document = Document.model_validate(json.load(file))
-        
+        document = self.store.load(key)
+
         corpus = []
         if document.abstract:
             corpus.append(document.abstract)
@@ -45,14 +94,29 @@ class KeywordClient:
 
     def detect_keywords(self):
         '''
-        Extract named entities from the corpus of documents
+        Extract named entities from the corpus of documents. Entity counts are cached per
+        document and only documents whose content changed are run through the pipeline.
         '''
-        corpus = []
-        for file in os.listdir(self.data_path):
-            key = file.replace('.json', '')
-            corpus.extend(self.document_to_corpus(key))
-        
-        named_entity_counts = self.extract_named_entities(corpus)
+        named_entity_counts = Counter()
+        changed = {}
+        for key, content_hash, counts in self.index.iter_entity_counts():
+            if counts is not None:
+                self.report.count('ner_documents_cached')
+                named_entity_counts.update(counts)
+            else:
+                changed[key] = content_hash
+
+        # Counts are written back chunk_size documents at a time as they come out of the pipeline
+        chunk = {}
+        for key, counts in self.extract_document_entities(list(changed)) if changed else ():
+            named_entity_counts.update(counts)
+            chunk[key] = (changed[key], dict(counts))
+            if len(chunk) >= self.chunk_size:
+                self.index.set_entity_counts(chunk)
+                chunk = {}
+        if chunk:
+            self.index.set_entity_counts(chunk)
+
         # Drop any entities that contain numbers
         named_entity_counts = {k: v for k, v in named_entity_counts.items() if not any(char.isdigit() for char in k)}
         # Remove starting string "the " from entities
@@ -60,23 +124,70 @@ class KeywordClient:
         # Select entities mentioned more than once
         named_entity_counts = {k: v for k, v in named_entity_counts.items() if v > 1}
 
-        return set(named_entity_counts.keys())
+        keywords = set(named_entity_counts.keys())
+        self.index.save_keywords(keywords)
+        return keywords
     
+    def set_keywords(self, keywords):
+        if set(keywords) != set(self.keywords):
+            self.keywords = keywords
+            self.matcher = KeywordMatcher(self.keywords)
+
+    @property
+    def keywords_hash(self) -> str:
+        return hashlib.sha1("\n".join(sorted(self.keywords)).encode('utf-8')).hexdigest()
+
     def highlight_keywords(self, text):
-        try:
-            escaped_keywords = [re.escape(k) for k in self.keywords]
-            
-            pattern = re.compile(r'\b(' + '|'.join(escaped_keywords) + r')\b', flags=re.IGNORECASE)
-            
-            def replace_func(match):
-                return f'[[{match.group(1)}]]'
-        
-            return pattern.sub(replace_func, text)
-        except TypeError:
+        if text is None:
             return text
+        return self.matcher.link(text)
+
+    def highlight_keywords_many(self, texts):
+        return [self.highlight_keywords(text) for text in texts]
     
-    def write_keyword_pages(self):
-        pass
+    def keyword_page(self, occurrences) -> str:
+        '''
+        Page content listing a keyword's occurrences under a link to each document
+        '''
+        lines = ["type:: Keyword", ""]
+        document_key = None
+        for occurrence in occurrences:
+            if occurrence['key'] != document_key:
+                document_key = occurrence['key']
+                lines.append(f"- [[{os.path.splitext(os.path.basename(occurrence['page_path']))[0]}]]")
+            icon = '🖊️' if occurrence['type'] == 'note' else '📖'
+            lines.append(f"  - {icon} {occurrence['text']}")
+        return "\n".join(lines) + "\n"
+
+    def write_keyword_pages(self, graph_path: str) -> int:
+        '''
+        Rewrite keyword pages whose occurrences changed since they were last written, from
+        the keyword index GraphClient.sync_graph builds while rendering. Document pages and
+        pages this client didn't write are left alone. Returns the number of pages written.
+        '''
+        written = self.index.keyword_pages()
+        document_pages = self.index.document_page_paths()
+        n_written = 0
+        for keyword in self.index.stale_keywords():
+            path = page_path(keyword)
+            filename = f"{graph_path}/{path}"
+            occurrences = self.index.keyword_occurrences(keyword)
+            ours = keyword in written and path not in document_pages
+            if not occurrences or path in document_pages or (not ours and os.path.exists(filename)):
+                if not occurrences and ours and os.path.exists(filename):
+                    os.remove(filename)
+                    self.report.count('keyword_pages_removed')
+                self.index.set_keyword_page(keyword, None)
+                continue
+
+            content = self.keyword_page(occurrences)
+            content_hash = hashlib.sha1(content.encode('utf-8')).hexdigest()
+            if written.get(keyword) != content_hash or not os.path.exists(filename):
+                write_atomic(filename, content)
+                self.report.count('keyword_pages_written')
+                n_written += 1
+            self.index.set_keyword_page(keyword, content_hash)
+        return n_written
 
 if __name__ == "__main__":
     # Output detected keywords to a file
@@ -0,0 +1,86 @@
+import re
+from typing import Iterable, List, Tuple
+
+TOKEN_PATTERN = re.compile(r'\w+|\W')
+WORD_CHARACTER = re.compile(r'\w')
+END = None
+
+def is_word_boundary(text: str, position: int) -> bool:
+    before = position > 0 and WORD_CHARACTER.match(text, position - 1) is not None
+    after = WORD_CHARACTER.match(text, position) is not None
+    return before != after
+
+class KeywordMatcher:
+    '''
+    Matches a fixed set of keywords in text, case-insensitively, on word boundaries and
+    preferring the longest keyword at each position. Keywords are compiled once into a
+    trie of tokens (runs of word characters or single other characters), so matching is
+    a single scan over the text however many keywords there are.
+    '''
+    def __init__(self, keywords: Iterable[str]):
+        self.root = {}
+        for keyword in keywords:
+            tokens = TOKEN_PATTERN.findall(keyword.lower())
+            if not tokens:
+                continue
+            node = self.root
+            for token in tokens:
+                node = node.setdefault(token, {})
+            node[END] = keyword
+
+    def matches(self, text: str) -> List[Tuple[int, int, str]]:
+        '''
+        Return (start, end, keyword) for non-overlapping keyword matches in text
+        '''
+        tokens = [(m.start(), m.end(), m.group().lower()) for m in TOKEN_PATTERN.finditer(text)]
+        spans = []
+        i = 0
+        while i < len(tokens):
+            longest = None
+            if is_word_boundary(text, tokens[i][0]):
+                node = self.root
+                j = i
+                while j < len(tokens) and tokens[j][2] in node:
+                    node = node[tokens[j][2]]
+                    j += 1
+                    if END in node and is_word_boundary(text, tokens[j - 1][1]):
+                        longest = j
+                        keyword = node[END]
+            if longest is None:
+                i += 1
+            else:
+                spans.append((tokens[i][0], tokens[longest - 1][1], keyword))
+                i = longest
+        return spans
+
+    def find(self, text: str) -> List[Tuple[int, int]]:
+        '''
+        Return (start, end) spans of non-overlapping keyword matches in text
+        '''
+        return [(start, end) for start, end, _ in self.matches(text)]
+
+    def link(self, text: str) -> str:
+        '''
+        Wrap each keyword match in text in a [[page link]]
+        '''
+        return self.link_keywords(text)[0]
+
+    def link_keywords(self, text: str) -> Tuple[str, List[str]]:
+        '''
+        Link text as link() does, also returning the keywords it links to, as given to the
+        matcher and without duplicates
+        '''
+        parts = []
+        keywords = []
+        position = 0
+        for start, end, keyword in self.matches(text):
+            parts.append(text[position:start])
+            parts.append(f'[[{text[start:end]}]]')
+            if keyword not in keywords:
+                keywords.append(keyword)
+            position = end
+        parts.append(text[position:])
+        return ''.join(parts), keywords
+
+    def link_many(self, texts: Iterable[str]) -> List[str]:
+        return [self.link(text) for text in texts]
@@ -0,0 +1,158 @@
+import os
+import hashlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from document_client import DocumentClient
+from document_store import Document, DocumentStore
+from request_scheduler import RequestScheduler
+from run_report import RunReport
+from zotero_client import ZoteroClient
+from typing import Dict, List, Optional, Tuple
+
+def parse_libraries(spec: str) -> List[Tuple[str, str]]:
+    '''
+    Parse a library list like "users/123, groups/456" into (library type, ID) pairs
+    '''
+    libraries = []
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        library_type, _, library_id = entry.partition('/')
+        if library_type not in ('users', 'groups') or not library_id:
+            raise ValueError(f"Libraries look like users/<id> or groups/<id>, not {entry!r}")
+        libraries.append((library_type, library_id))
+    return libraries
+
+def merge_documents(key: str, documents: List[Document]) -> Document:
+    '''
+    Merge copies of a paper from several libraries, keeping the first copy's title and
+    the first abstract, and every distinct highlight and note
+    '''
+    def distinct(items):
+        seen = set()
+        for item in items:
+            if (item.text, item.mtime) not in seen:
+                seen.add((item.text, item.mtime))
+                yield item
+
+    return Document(
+        key=key,
+        version=max(document.version for document in documents),
+        title=documents[0].title,
+        abstract=next((document.abstract for document in documents if document.abstract), None),
+        collections=list(dict.fromkeys(c for document in documents for c in document.collections)),
+        annotations=list(distinct(a for document in documents for a in document.annotations)),
+        notes=list(distinct(n for document in documents for n in document.notes))
+    )
+
+class LibrarySync:
+    '''
+    Syncs several Zotero user and group libraries into one graph. Each library has its own
+    DocumentClient, data namespace and version checkpoint under DATA_PATH/libraries, and
+    all of them share one RequestScheduler, so libraries sync in parallel under a single
+    rate limit and a per-run request budget counts the requests of every library. Library
+    documents are then merged into the store in DATA_PATH that keywords and pages are
+    built from: copies of a paper with the same page title in several libraries become
+    one document, and only pages whose sources changed are merged again. Clients are
+    given in priority order; the first copy of a paper wins its metadata.
+    '''
+    def __init__(self, clients: Dict[str, DocumentClient], data_path: str, graph_path: str,
+                 max_workers: int = 4, report: Optional[RunReport] = None):
+        self.clients = clients
+        self.graph_path = graph_path
+        self.max_workers = max_workers
+        self.report = report or RunReport()
+        self.store = DocumentStore(data_path)
+        self.index = self.store.index
+
+    @classmethod
+    def from_libraries(cls, libraries: List[Tuple[str, str]], zotero_api_key: str, data_path: str, graph_path: str,
+                       cache_path: Optional[str] = None, base_url: Optional[str] = None,
+                       scheduler: Optional[RequestScheduler] = None, sync_workers: int = 8, max_workers: int = 4,
+                       report: Optional[RunReport] = None, max_requests: Optional[int] = None,
+                       max_seconds: Optional[float] = None, priority: str = 'recent') -> 'LibrarySync':
+        scheduler = scheduler or RequestScheduler()
+        clients = {}
+        for library_type, library_id in libraries:
+            name = f"{library_type}_{library_id}"
+            library_path = f"{data_path}/libraries/{name}"
+            os.makedirs(library_path, exist_ok=True)
+            zotero_client = ZoteroClient(library_id, zotero_api_key, cache_path, base_url=base_url,
+                                         scheduler=scheduler, report=report, library_type=library_type)
+            # Library clients don't own graph pages, pages of merged documents are removed by merge()
+            clients[name] = DocumentClient(zotero_client, library_path, None, sync_workers, report=report,
+                                           max_requests=max_requests, max_seconds=max_seconds, priority=priority)
+        return cls(clients, data_path, graph_path, max_workers, report)
+
+    def read_library_version(self) -> Tuple[Optional[int], ...]:
+        return tuple(client.read_library_version() for client in self.clients.values())
+
+    def sync_pending(self) -> bool:
+        return any(client.sync_pending() for client in self.clients.values())
+
+    def sync_documents(self):
+        '''
+        Sync every library in parallel, then merge them. Returns a dict of "library/key" ->
+        exception for documents that failed, or "library" -> exception for a library that
+        couldn't be synced at all.
+        '''
+        failed = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {name: executor.submit(client.sync_documents) for name, client in self.clients.items()}
+            for name, future in futures.items():
+                try:
+                    failed.update({f"{name}/{key}": e for key, e in future.result().items()})
+                except Exception as e:
+                    print(f"Failed to sync library {name}: {e}")
+                    failed[name] = e
+        self.merge()
+        return failed
+
+    def merge(self) -> int:
+        '''
+        Merge library documents into the graph store, writing only documents whose sources
+        changed and removing documents (and their pages) no library has any more. Returns
+        the number of documents written.
+        '''
+        sources = defaultdict(list)
+        for name, client in self.clients.items():
+            for key, page_path, content_hash in client.index.document_pages():
+                sources[page_path].append((name, key, content_hash))
+
+        merged = self.index.merged_sources()
+        # Documents synced straight into DATA_PATH before it held merged libraries
+        for key in self.index.keys():
+            if key not in merged:
+                self.store.delete(key)
+        for key, (page_path, _) in list(merged.items()):
+            if page_path not in sources:
+                page = f"{self.graph_path}/{self.index.page_file(key) or page_path}"
+                if os.path.exists(page):
+                    os.remove(page)
+                self.index.set_page_file(key, None)
+                self.store.delete(key)
+                self.report.count('documents_merged_deleted')
+                del merged[key]
+
+        keys_by_page = {page_path: key for key, (page_path, _) in merged.items()}
+        n_written = 0
+        for page_path, copies in sources.items():
+            sources_hash = hashlib.sha1("\n".join(f"{name}:{key}:{content_hash}" for name, key, content_hash in copies)
+                                        .encode('utf-8')).hexdigest()
+            key = keys_by_page.get(page_path)
+            if key is None:
+                # Zotero keys are unique within a library only
+                name, key, _ = copies[0]
+                if key in merged:
+                    key = f"{key}-{name}"
+            elif merged[key][1] == sources_hash:
+                self.report.count('documents_merged_skipped')
+                continue
+            documents = [self.clients[name].store.load(source_key) for name, source_key, _ in copies]
+            self.store.save(merge_documents(key, documents))
+            self.index.set_merged_source(key, page_path, sources_hash)
+            merged[key] = (page_path, sources_hash)
+            self.report.count('documents_merged')
+            n_written += 1
+        return n_written
@@ -1,19 +1,144 @@
+'''
+Sync a Zotero library into a Logseq graph.
 
+    python src/main.py [sync-docs | detect-keywords | render | backfill-journals | all | watch]
+
+Without a command all stages run in order, as the cron job expects. Each stage imports
+its clients when it runs, so a documents-only sync or journal backfill never loads
+spaCy, and `--help` never loads anything.
+
+ZOTERO_LIBRARIES (e.g. "users/123, groups/456") syncs several libraries into one graph;
+otherwise the personal library of ZOTERO_USER_ID is synced.
+
+A run can be limited to SYNC_MAX_REQUESTS Zotero requests and/or SYNC_MAX_SECONDS,
+syncing the most recently modified documents first (SYNC_PRIORITY=recent) or those with
+annotations first (SYNC_PRIORITY=annotated); later runs carry on where it stopped.
+With RENDER_EVERY set, pages of a single library are rendered every RENDER_EVERY synced
+documents, with the keywords of the last render, so they show up while the sync runs.
+'''
 import os
+import argparse
 from dotenv import load_dotenv
-from zotero_client import ZoteroClient
-from document_client import DocumentClient
-from graph_client import GraphClient
-from keyword_client import KeywordClient
+from run_report import RunReport
 
-if __name__ == "__main__":
-    load_dotenv()
-    zotero_client = ZoteroClient(os.getenv('ZOTERO_USER_ID'), os.getenv('ZOTERO_API_KEY'))
-    document_client = DocumentClient(zotero_client, os.getenv('DATA_PATH'), os.getenv('GRAPH_PATH'))
-    document_client.sync_documents()
+def sync_budget() -> dict:
+    max_requests, max_seconds = os.getenv('SYNC_MAX_REQUESTS'), os.getenv('SYNC_MAX_SECONDS')
+    return {
+        'max_requests': int(max_requests) if max_requests else None,
+        'max_seconds': float(max_seconds) if max_seconds else None,
+        'priority': os.getenv('SYNC_PRIORITY', 'recent'),
+    }
+
+def document_client(report: RunReport, scheduler):
+    if os.getenv('ZOTERO_LIBRARIES'):
+        from library_sync import LibrarySync, parse_libraries
+        return LibrarySync.from_libraries(
+            parse_libraries(os.getenv('ZOTERO_LIBRARIES')), os.getenv('ZOTERO_API_KEY'), os.getenv('DATA_PATH'),
+            os.getenv('GRAPH_PATH'), os.getenv('CACHE_PATH'), os.getenv('ZOTERO_BASE_URL'), scheduler,
+            int(os.getenv('SYNC_WORKERS', 8)), int(os.getenv('LIBRARY_WORKERS', 4)), report=report, **sync_budget())
+    from zotero_client import ZoteroClient
+    from document_client import DocumentClient
+    zotero_client = ZoteroClient(os.getenv('ZOTERO_USER_ID'), os.getenv('ZOTERO_API_KEY'), os.getenv('CACHE_PATH'),
+                                 base_url=os.getenv('ZOTERO_BASE_URL'), scheduler=scheduler, report=report)
+    client = DocumentClient(zotero_client, os.getenv('DATA_PATH'), os.getenv('GRAPH_PATH'),
+                            int(os.getenv('SYNC_WORKERS', 8)), report=report, **sync_budget())
+    if os.getenv('RENDER_EVERY'):
+        client.on_progress = progress_renderer(report)
+        client.progress_every = int(os.getenv('RENDER_EVERY'))
+    return client
+
+def keyword_client(report: RunReport, detect: bool = True):
+    from keyword_client import KeywordClient
+    # Learn keywords from documents, don't use pre-defined keywords
+    return KeywordClient(os.getenv('DATA_PATH'), [], int(os.getenv('NER_PROCESSES', 1)), report=report, detect=detect)
+
+def graph_client(report: RunReport, keywords=None):
+    from graph_client import GraphClient
+    return GraphClient(os.getenv('DATA_PATH'), os.getenv('GRAPH_PATH'), os.getenv('TEMPLATE_PATH'), keywords,
+                       int(os.getenv('RENDER_PROCESSES', 1)), report=report)
+
+def progress_renderer(report: RunReport):
+    # Documents are still being updated, so pages of deleted documents are only collected by the full render
+    graph = graph_client(report, keyword_client(report, detect=False))
+    def render():
+        with report.stage('render_progress'):
+            print(f"Rendered {graph.sync_graph(collect_orphans=False)} pages of synced documents")
+    return render
+
+def sync_docs(report: RunReport):
+    from request_scheduler import RequestScheduler
+    # One scheduler for every library, so they share the request budget
+    scheduler = RequestScheduler()
+    client = document_client(report, scheduler)
+    with report.stage('sync_documents'):
+        client.sync_documents()
+    metrics = scheduler.metrics()
+    report.set('scheduler', metrics)
+    print(f"Zotero requests: {metrics}")
 
-    keyword_client = KeywordClient(os.getenv('DATA_PATH'), []) # Learn keywords from documents, don't use pre-defined keywords
-    gc = GraphClient(os.getenv('DATA_PATH'), os.getenv('GRAPH_PATH'), os.getenv('TEMPLATE_PATH'), keyword_client)
+def detect_keywords(report: RunReport):
+    with report.stage('detect_keywords'):
+        keywords = keyword_client(report).keywords
+    if os.getenv('KEYWORD_PATH'):
+        with open(f"{os.getenv('KEYWORD_PATH')}/ner_results.txt", 'w') as file:
+            for k in sorted(keywords):
+                file.write(f"{k}\n")
+    print(f"Detected {len(keywords)} keywords")
 
-    gc.sync_graph()
-    gc.backfill_journal_pages()
\ No newline at end of file
+def render(report: RunReport):
+    with report.stage('detect_keywords'):
+        keywords = keyword_client(report)
+    with report.stage('render_pages'):
+        graph_client(report, keywords).sync_graph()
+    with report.stage('keyword_pages'):
+        keywords.write_keyword_pages(os.getenv('GRAPH_PATH'))
+
+def backfill_journals(report: RunReport):
+    with report.stage('backfill_journals'):
+        graph_client(report).backfill_journal_pages()
+
+def run_all(report: RunReport):
+    sync_docs(report)
+    render(report)
+    backfill_journals(report)
+
+def watch(report: RunReport):
+    from sync_daemon import SyncDaemon
+    from request_scheduler import RequestScheduler
+    documents = document_client(report, RequestScheduler())
+    documents.sync_documents()
+    keywords = keyword_client(report)
+    graph = graph_client(report, keywords)
+    graph.sync_graph()
+    keywords.write_keyword_pages(graph.graph_path)
+    SyncDaemon(documents, keywords, graph, float(os.getenv('WATCH_INTERVAL', 60)), os.getenv('TRIGGER_PATH')).run()
+
+COMMANDS = {
+    'sync-docs': (sync_docs, 'fetch new, changed and deleted documents from Zotero'),
+    'detect-keywords': (detect_keywords, 'detect keywords and write them to KEYWORD_PATH/ner_results.txt'),
+    'render': (render, 'render document and keyword pages for changed documents'),
+    'backfill-journals': (backfill_journals, 'write journal pages for days with notes and highlights'),
+    'all': (run_all, 'sync documents, render pages and backfill journals (default)'),
+    'watch': (watch, 'keep everything loaded and sync whenever the library changes'),
+}
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    for name, (_, help) in COMMANDS.items():
+        subparsers.add_parser(name, help=help, description=help)
+    args = parser.parse_args(argv)
+    args.command = args.command or 'all'
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    load_dotenv()
+    # REPORT_PATH: write a JSON run report, PROFILE_PATH: dump cProfile stats per stage
+    report = RunReport(os.getenv('PROFILE_PATH'))
+    COMMANDS[args.command][0](report)
+    if os.getenv('REPORT_PATH'):
+        report.write(os.getenv('REPORT_PATH'))
+
+if __name__ == "__main__":
+    main()
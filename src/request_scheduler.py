@@ -0,0 +1,160 @@
+import time
+import random
+import threading
+import requests
+from email.utils import parsedate_to_datetime
+from typing import Callable, Optional
+
+class RequestScheduler:
+    '''
+    Schedules requests to the Zotero API. Requests are rate limited with a token bucket,
+    retried with jittered exponential backoff on 429/503 and connection errors, and
+    paused while the server asks clients to back off (Backoff / Retry-After headers).
+    The number of requests in flight shrinks when the server throttles and grows back
+    after a run of successful requests. One scheduler can be shared by several clients.
+    '''
+    def __init__(
+        self,
+        rate: float = 20.0,
+        burst: int = 20,
+        max_concurrency: int = 8,
+        min_concurrency: int = 1,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        increase_after: int = 20):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.increase_after = increase_after
+
+        self.concurrency = max_concurrency
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._in_flight = 0
+        self._successes = 0
+        self._lock = threading.Lock()
+        self._slots = threading.Condition(self._lock)
+
+        self.request_count = 0
+        self.retries = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                'requests': self.request_count,
+                'retries': self.retries,
+                'throttled': self.throttled,
+                'wait_seconds': round(self.wait_seconds, 3),
+                'concurrency': self.concurrency,
+            }
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _wait(self):
+        '''
+        Block until the server backoff has passed, a token is available and a slot is free
+        '''
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+                self._refilled_at = now
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                elif self._tokens < 1:
+                    delay = (1 - self._tokens) / self.rate
+                else:
+                    self._tokens -= 1
+                    break
+            time.sleep(delay)
+            waited += delay
+
+        with self._slots:
+            started = time.monotonic()
+            while self._in_flight >= self.concurrency:
+                self._slots.wait()
+            self._in_flight += 1
+            self.request_count += 1
+            self.wait_seconds += waited + time.monotonic() - started
+
+    def _release(self):
+        with self._slots:
+            self._in_flight -= 1
+            self._slots.notify_all()
+
+    def _on_success(self):
+        with self._slots:
+            self._successes += 1
+            if self._successes >= self.increase_after and self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self._successes = 0
+                self._slots.notify_all()
+
+    def _on_throttled(self):
+        with self._lock:
+            self.throttled += 1
+            self._successes = 0
+            self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+
+    def retry_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                try:
+                    return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def execute(self, send: Callable[[], requests.Response]) -> requests.Response:
+        '''
+        Send a request through the scheduler. The last throttled response is returned
+        once retries are exhausted so the caller can raise_for_status as usual.
+        '''
+        for attempt in range(self.max_retries + 1):
+            self._wait()
+            try:
+                response = send()
+            except (requests.ConnectionError, requests.Timeout):
+                self._release()
+                if attempt == self.max_retries:
+                    raise
+                delay = self.retry_delay(attempt)
+                with self._lock:
+                    self.retries += 1
+                    self.wait_seconds += delay
+                time.sleep(delay)
+                continue
+            except BaseException:
+                self._release()
+                raise
+            self._release()
+
+            backoff = response.headers.get('Backoff')
+            if backoff:
+                self.pause(self.retry_delay(attempt, backoff))
+
+            if response.status_code not in (429, 503):
+                self._on_success()
+                return response
+
+            self._on_throttled()
+            if attempt == self.max_retries:
+                return response
+            with self._lock:
+                self.retries += 1
+            self.pause(self.retry_delay(attempt, response.headers.get('Retry-After')))
+            response.close()
+        return response
@@ -0,0 +1,37 @@
+import os
+import json
+import hashlib
+import threading
+from typing import Optional
+
+class ResponseCache:
+    '''
+    On-disk cache of Zotero API responses keyed by request URL. Each entry stores the
+    library version and ETag the response was served with, so it can be revalidated
+    with a conditional request and reused when the API answers 304 Not Modified.
+    '''
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+        os.makedirs(cache_path, exist_ok=True)
+
+    def entry_path(self, url: str) -> str:
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return f"{self.cache_path}/{digest}.json"
+
+    def get(self, url: str) -> Optional[dict]:
+        try:
+            with open(self.entry_path(url)) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    def set(self, url: str, body, headers: dict, version: Optional[str], etag: Optional[str]):
+        entry = {'url': url, 'version': version, 'etag': etag, 'headers': headers, 'body': body}
+        path = self.entry_path(url)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,75 @@
+import os
+import re
+import json
+import time
+import cProfile
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+ITEM_KEY_PATTERN = re.compile(r'items/[A-Z0-9]{8}')
+
+def endpoint_name(path: str) -> str:
+    return ITEM_KEY_PATTERN.sub('items/{key}', path)
+
+class RunReport:
+    '''
+    Collects wall time per pipeline stage, counters and HTTP request statistics for one
+    run, and writes them as a JSON report. With profile_path set, each stage is also run
+    under cProfile and its stats are dumped to {profile_path}/{stage}.prof.
+    '''
+    def __init__(self, profile_path: Optional[str] = None):
+        self.profile_path = profile_path
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.http = {}
+        self.extra = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        profiler = cProfile.Profile() if self.profile_path else None
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+                os.makedirs(self.profile_path, exist_ok=True)
+                profiler.dump_stats(f"{self.profile_path}/{name}.prof")
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record_request(self, path: str, n_bytes: int, cache_hit: bool = False):
+        endpoint = endpoint_name(path)
+        with self._lock:
+            stats = self.http.setdefault(endpoint, {'requests': 0, 'bytes': 0, 'cache_hits': 0})
+            stats['requests'] += 1
+            stats['bytes'] += n_bytes
+            stats['cache_hits'] += cache_hit
+
+    def set(self, name: str, value):
+        with self._lock:
+            self.extra[name] = value
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started)),
+                'wall_seconds': round(time.time() - self.started, 3),
+                'stages': {name: round(seconds, 3) for name, seconds in self.stages.items()},
+                'counters': dict(self.counters),
+                'http': {endpoint: dict(stats) for endpoint, stats in self.http.items()},
+                **self.extra,
+            }
+
+    def write(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
@@ -0,0 +1,47 @@
+import time
+from request_scheduler import RequestScheduler
+from typing import Iterable, Iterator, Optional, TypeVar
+
+T = TypeVar('T')
+
+class SyncBudget:
+    '''
+    Limits one sync run to max_requests Zotero API requests, as counted by the request
+    scheduler, and/or max_seconds of wall time. Work is only started while the budget
+    lasts and work in flight is left to finish, so a run goes over by at most the
+    documents being fetched when the budget ran out. Clients sharing a scheduler spend
+    from the same request count.
+    '''
+    def __init__(self, max_requests: Optional[int] = None, max_seconds: Optional[float] = None,
+                 scheduler: Optional[RequestScheduler] = None):
+        if max_requests is not None and scheduler is None:
+            raise ValueError("A request budget needs the scheduler that counts requests")
+        self.max_requests = max_requests
+        self.scheduler = scheduler
+        self.started_requests = self.requests()
+        self.deadline = time.monotonic() + max_seconds if max_seconds is not None else None
+
+    def requests(self) -> int:
+        return self.scheduler.metrics()['requests'] if self.scheduler is not None else 0
+
+    def requests_left(self) -> Optional[int]:
+        if self.max_requests is None:
+            return None
+        return max(0, self.max_requests - (self.requests() - self.started_requests))
+
+    def exhausted(self) -> bool:
+        if self.max_requests is not None and self.requests() - self.started_requests >= self.max_requests:
+            return True
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def take(self, items: Iterable[T]) -> Iterator[T]:
+        '''
+        Yield items while the budget lasts, checking it before taking each item so items
+        left in the iterator when the budget runs out are still there
+        '''
+        items = iter(items)
+        while not self.exhausted():
+            try:
+                yield next(items)
+            except StopIteration:
+                return
@@ -0,0 +1,88 @@
+import os
+import signal
+import time
+import threading
+from dotenv import load_dotenv
+from typing import Optional
+from zotero_client import ZoteroClient
+from document_client import DocumentClient
+from graph_client import GraphClient
+from keyword_client import KeywordClient
+
+class SyncDaemon:
+    '''
+    Keeps the clients resident and polls Zotero for library changes. The NLP pipeline,
+    keyword matcher and templates stay loaded between polls, and each poll only pushes
+    changed documents through sync, keyword detection and page rendering. A poll can be
+    triggered early with SIGUSR1 or by creating trigger_path.
+    '''
+    def __init__(
+        self,
+        document_client: DocumentClient,
+        keyword_client: KeywordClient,
+        graph_client: GraphClient,
+        interval: float = 60,
+        trigger_path: Optional[str] = None):
+        self.document_client = document_client
+        self.keyword_client = keyword_client
+        self.graph_client = graph_client
+        self.interval = interval
+        self.trigger_path = trigger_path
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+
+    def run_once(self) -> bool:
+        '''
+        Sync once, returning whether the library changed
+        '''
+        version = self.document_client.read_library_version()
+        failed = self.document_client.sync_documents()
+        # A run that spent its budget leaves the checkpoint alone but may have synced documents
+        if not failed and not self.document_client.sync_pending() and self.document_client.read_library_version() == version:
+            return False
+
+        self.keyword_client.set_keywords(self.keyword_client.detect_keywords())
+        n_written = self.graph_client.sync_graph()
+        self.keyword_client.write_keyword_pages(self.graph_client.graph_path)
+        self.graph_client.backfill_journal_pages()
+        print(f"Library changed, wrote {n_written} pages")
+        return True
+
+    def triggered(self) -> bool:
+        if self.trigger_path and os.path.exists(self.trigger_path):
+            os.remove(self.trigger_path)
+            return True
+        return self.wake.is_set()
+
+    def wait(self):
+        deadline = time.monotonic() + self.interval
+        while not self.stopped.is_set() and time.monotonic() < deadline:
+            if self.triggered():
+                break
+            self.wake.wait(min(1.0, max(0.0, deadline - time.monotonic())))
+        self.wake.clear()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+
+    def run(self):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.wake.set())
+        while not self.stopped.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Sync failed: {e}")
+            self.wait()
+
+if __name__ == "__main__":
+    load_dotenv()
+    zotero_client = ZoteroClient(os.getenv('ZOTERO_USER_ID'), os.getenv('ZOTERO_API_KEY'), os.getenv('CACHE_PATH'))
+    document_client = DocumentClient(zotero_client, os.getenv('DATA_PATH'), os.getenv('GRAPH_PATH'), int(os.getenv('SYNC_WORKERS', 8)))
+    document_client.sync_documents()
+    keyword_client = KeywordClient(os.getenv('DATA_PATH'), [], int(os.getenv('NER_PROCESSES', 1)))
+    gc = GraphClient(os.getenv('DATA_PATH'), os.getenv('GRAPH_PATH'), os.getenv('TEMPLATE_PATH'), keyword_client, int(os.getenv('RENDER_PROCESSES', 1)))
+    gc.sync_graph()
+    keyword_client.write_keyword_pages(gc.graph_path)
+    daemon = SyncDaemon(document_client, keyword_client, gc, float(os.getenv('WATCH_INTERVAL', 60)), os.getenv('TRIGGER_PATH'))
+    daemon.run()
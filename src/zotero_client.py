@@ -1,10 +1,15 @@
 import requests
-from datetime import datetime
+import threading
 import zipfile
-from pydantic import BaseModel, Field, validator
-from typing import Optional
-from bs4 import BeautifulSoup
-from io import BytesIO
+from pydantic import BaseModel, Field, field_validator
+from typing import Callable, List, Optional
+import io
+import tempfile
+from html.parser import HTMLParser
+from response_cache import ResponseCache
+from request_scheduler import RequestScheduler
+from run_report import RunReport
+from urllib.parse import urlparse
 
 class ZoteroDocumentData(BaseModel):
     title: str
@@ -19,17 +24,20 @@ class ZoteroDocument(BaseModel):
 
 class ZoteroAttachmentData(BaseModel):
     filename: Optional[str] = Field('')
+    md5: Optional[str] = None
     mtime: str = Field(..., alias='dateModified')
 
 class ZoteroAttachment(BaseModel):
     key: str
+    version: Optional[int] = None
     data: ZoteroAttachmentData
 
 class ZoteroAttachmentHighlightData(BaseModel):
     text: str = Field(..., alias='annotationText')
     mtime: str = Field(..., alias='dateModified')
 
-    @validator('text', pre=True)
+    @field_validator('text', mode='before')
+    @classmethod
     def trim_text(cls, value: str) -> str:
         if isinstance(value, str):
             return value.strip()
@@ -43,7 +51,8 @@ class ZoteroAttachmentNoteData(BaseModel):
     text: str = Field(..., alias='annotationComment')
     mtime: str = Field(..., alias='dateModified')
 
-    @validator('text', pre=True)
+    @field_validator('text', mode='before')
+    @classmethod
     def trim_text(cls, value: str) -> str:
         if isinstance(value, str):
             return value.strip()
@@ -59,27 +68,319 @@ class ZoteroNoteData(BaseModel):
 
 class ZoteroNote(BaseModel):
     key: str
+    version: Optional[int] = None
     data: ZoteroNoteData
 
+class KindleNotebookParser(HTMLParser):
+    '''
+    Incrementally collects the text of <div class="noteText"> elements from a Kindle
+    notebook export. Kindle sometimes closes a note with a stray </h3>, so a note also
+    ends at the next heading.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.highlights = []
+        self._text = None
+        self._depth = 0
+
+    def _end_note(self):
+        if self._text is not None:
+            self.highlights.append(''.join(self._text))
+            self._text = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('h1', 'h2', 'h3'):
+            self._end_note()
+        elif tag == 'div':
+            classes = (dict(attrs).get('class') or '').split()
+            if 'noteText' in classes:
+                self._end_note()
+                self._text = []
+                self._depth = 0
+            elif self._text is not None:
+                self._depth += 1
+
+    def handle_endtag(self, tag):
+        if self._text is None:
+            return
+        if tag in ('h1', 'h2', 'h3'):
+            self._end_note()
+        elif tag == 'div':
+            if self._depth == 0:
+                self._end_note()
+            else:
+                self._depth -= 1
+
+    def handle_data(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+    def close(self):
+        super().close()
+        self._end_note()
+
+# Bump when NoteBlockParser output changes, so notes cached by an older parser are parsed again
+NOTE_PARSER_VERSION = 2
+
+class NoteBlockParser(HTMLParser):
+    '''
+    Splits the HTML of a Zotero child note into one line of text per block (paragraph,
+    heading, list item, quote, table row or line break) while tokenizing, without building
+    a tree. List items keep their marker, "- " or their number in an ordered list, the
+    cells of a table row are separated by " | ", and each line of a <pre> block is a
+    block of its own.
+    '''
+    BLOCK_TAGS = {'p', 'div', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li', 'blockquote', 'pre',
+                  'tr', 'dt', 'dd', 'table', 'ul', 'ol', 'hr', 'br'}
+    SKIP_TAGS = {'script', 'style'}
+
+    def __init__(self):
+        super().__init__()
+        self.blocks = []
+        self._text = []
+        self._marker = ''
+        self._lists = []
+        self._pre = 0
+        self._skip = 0
+        self._cells = 0
+
+    def _end_block(self):
+        text = ''.join(self._text)
+        self._text = []
+        if self._pre:
+            lines = [line.rstrip() for line in text.split('\n')]
+        else:
+            lines = [' '.join(text.split())]
+        for line in lines:
+            if line.strip():
+                self.blocks.append(f"{self._marker}{line}")
+                self._marker = ''
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip += 1
+        if tag in ('td', 'th'):
+            if self._cells:
+                self._text.append(' | ')
+            self._cells += 1
+        if tag not in self.BLOCK_TAGS:
+            return
+        self._end_block()
+        if tag == 'tr':
+            self._cells = 0
+        elif tag in ('ul', 'ol'):
+            self._lists.append(0 if tag == 'ol' else None)
+        elif tag == 'li':
+            if self._lists and self._lists[-1] is not None:
+                self._lists[-1] += 1
+                self._marker = f"{self._lists[-1]}. "
+            else:
+                self._marker = '- '
+        elif tag == 'pre':
+            self._pre += 1
+
+    def handle_startendtag(self, tag, attrs):
+        # A self-closed <script/> or <style/> has no content to skip
+        if tag in self.SKIP_TAGS:
+            return
+        if tag in self.BLOCK_TAGS:
+            self._end_block()
+        else:
+            self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        if tag not in self.BLOCK_TAGS:
+            return
+        self._end_block()
+        # A list item's marker goes on its first line, an empty item has no line
+        if tag == 'tr':
+            self._cells = 0
+        elif tag == 'li':
+            self._marker = ''
+        elif tag in ('ul', 'ol') and self._lists:
+            self._lists.pop()
+        elif tag == 'pre':
+            self._pre = max(0, self._pre - 1)
+
+    def handle_data(self, data):
+        if not self._skip:
+            self._text.append(data)
+
+    def close(self):
+        super().close()
+        self._end_block()
+
+def note_blocks(html: str) -> List[str]:
+    parser = NoteBlockParser()
+    parser.feed(html)
+    parser.close()
+    return parser.blocks
+
+class PendingResponse:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
 class ZoteroClient:
-    def __init__(self, zotero_user_id: str, zotero_api_key: str):
+    def __init__(self, zotero_user_id: str, zotero_api_key: str, cache_path: Optional[str] = None,
+                 base_url: Optional[str] = None, pool_size: int = 32,
+                 scheduler: Optional[RequestScheduler] = None, report: Optional[RunReport] = None,
+                 library_type: str = 'users'):
+        if library_type not in ('users', 'groups'):
+            raise ValueError(f"library_type must be 'users' or 'groups', not {library_type!r}")
+        # For group libraries zotero_user_id is the group ID
         self.zotero_user_id = zotero_user_id
+        self.library_type = library_type
         self.zotero_api_key = zotero_api_key
-    
-    def get_item_versions(self):
-        url = f"https://api.zotero.org/users/{self.zotero_user_id}/items/top?format=versions"
-        with requests.get(url, headers={"Authorization": f"Bearer {self.zotero_api_key}",
-                                                  "Accept": "application/json"}) as response:
+        self.base_url = base_url or "https://api.zotero.org"
+        self.scheduler = scheduler or RequestScheduler()
+        self.report = report or RunReport()
+        self.last_modified_version = None
+
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": f"Bearer {self.zotero_api_key}",
+                                     "Accept": "application/json"})
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.cache = ResponseCache(cache_path) if cache_path else None
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+    def library_url(self, path: str) -> str:
+        return f"{self.base_url}/{self.library_type}/{self.zotero_user_id}/{path}"
+
+    def _get(self, url: str, params: Optional[dict] = None, headers: Optional[dict] = None, stream: bool = False):
+        response = self.scheduler.execute(
+            lambda: self.session.get(url, params=params, headers=headers, stream=stream))
+        # Report endpoints without the /users/{id}/ or /groups/{id}/ prefix
+        path = urlparse(url).path
+        prefix = urlparse(self.library_url('')).path
+        if path.startswith(prefix):
+            path = path[len(prefix):]
+        n_bytes = int(response.headers.get('Content-Length', 0)) if stream else len(response.content)
+        self.report.record_request(path, n_bytes, response.status_code == 304)
+        return response
+
+    def _get_json(self, url: str, params: Optional[dict] = None, cache: bool = True):
+        '''
+        GET a JSON endpoint, returning (body, headers). Identical requests made while one
+        is in flight share its response. With a cache, responses are revalidated with
+        If-None-Match / If-Modified-Since-Version so a 304 is served from disk; pass
+        cache=False for one-off URLs that would never be requested again.
+        '''
+        request_url = requests.Request('GET', url, params=params).prepare().url
+        with self._pending_lock:
+            pending = self._pending.get(request_url)
+            if pending is None:
+                self._pending[request_url] = pending = PendingResponse()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            pending.done.wait()
+            if pending.result is not None:
+                return pending.result
+            return self._fetch_json(request_url, cache)
+
+        try:
+            pending.result = self._fetch_json(request_url, cache)
+            return pending.result
+        finally:
+            with self._pending_lock:
+                del self._pending[request_url]
+            pending.done.set()
+
+    def _fetch_json(self, request_url: str, cache: bool = True):
+        response_cache = self.cache if cache else None
+        entry = response_cache.get(request_url) if response_cache else None
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers["If-None-Match"] = entry['etag']
+            elif entry['version']:
+                headers["If-Modified-Since-Version"] = entry['version']
+
+        with self._get(request_url, headers=headers) as response:
+            if response.status_code == 304 and entry is not None:
+                return entry['body'], entry['headers']
             response.raise_for_status()
-            return response.json()
+            body = response.json()
+            kept_headers = {
+                name: response.headers[name]
+                for name in ('Last-Modified-Version', 'Total-Results')
+                if name in response.headers
+            }
+            if response_cache:
+                response_cache.set(request_url, body, kept_headers,
+                                   response.headers.get('Last-Modified-Version'),
+                                   response.headers.get('ETag'))
+            return body, kept_headers
 
-    def get_item(self, key: str): 
-        url = f"https://api.zotero.org/users/{self.zotero_user_id}/items/{key}"
-        with requests.get(url, headers={"Authorization": f"Bearer {self.zotero_api_key}",
-                                                  "Accept": "application/json"}) as response:
+    def get_item_versions(self, since: Optional[int] = None):
+        '''
+        Return a map of top-level item key -> version. If since is given, only items
+        modified after that library version are returned. The library version of the
+        response is stored in last_modified_version.
+        '''
+        params = {"format": "versions"}
+        headers = {}
+        if since is not None:
+            params["since"] = since
+            headers["If-Modified-Since-Version"] = str(since)
+        with self._get(self.library_url("items/top"), params=params, headers=headers) as response:
+            if response.status_code == 304:
+                self.last_modified_version = since
+                return {}
             response.raise_for_status()
+            self.last_modified_version = int(response.headers['Last-Modified-Version'])
             return response.json()
+
+    def get_deleted_items(self, since: int):
+        deleted, _ = self._get_json(self.library_url("deleted"), params={"since": since}, cache=False)
+        return deleted['items']
+
+    def get_item(self, key: str): 
+        item, _ = self._get_json(self.library_url(f"items/{key}"))
+        return item
     
+    def get_items(self, keys: list[str]):
+        '''
+        Fetch items in batches of 50 keys (the API maximum for itemKey) per request
+        '''
+        items = []
+        for i in range(0, len(keys), 50):
+            params = {"itemKey": ",".join(keys[i:i + 50]), "limit": 50}
+            page, _ = self._get_json(self.library_url("items"), params=params, cache=False)
+            items.extend(page)
+        return items
+
+    def count_items(self, item_type: str) -> int:
+        _, headers = self._get_json(self.library_url("items"), params={"itemType": item_type, "limit": 1}, cache=False)
+        return int(headers.get('Total-Results', 0))
+
+    def iter_all_items(self, item_type: str, limit: int = 100):
+        '''
+        Page through every item in the library matching item_type (e.g. "attachment || note"),
+        yielding items as each page arrives so only one page is held at a time
+        '''
+        start = 0
+        while True:
+            params = {"itemType": item_type, "limit": limit, "start": start}
+            page, headers = self._get_json(self.library_url("items"), params=params)
+            total = int(headers.get('Total-Results', 0))
+            yield from page
+            start += len(page)
+            if len(page) == 0 or start >= total:
+                return
+
+    def get_all_items(self, item_type: str, limit: int = 100):
+        return list(self.iter_all_items(item_type, limit))
+
     def get_document(self, key: str):
         document_json = self.get_item(key)
         if document_json['data']['itemType'] != 'note':            
@@ -87,96 +388,125 @@ class ZoteroClient:
             return document
     
     def get_document_child_notes(self, parent_key: str):
-        url = f"https://api.zotero.org/users/{self.zotero_user_id}/items/{parent_key}/children?itemType=note"
-        with requests.get(url, headers={"Authorization": f"Bearer {self.zotero_api_key}",
-                                                    "Accept": "application/json"}) as response:
-            response.raise_for_status()
-            return [ZoteroNote(**note) for note in response.json()]
+        notes, _ = self._get_json(self.library_url(f"items/{parent_key}/children"), params={"itemType": "note"})
+        return [ZoteroNote(**note) for note in notes]
                 
     def get_attachment_items(self, parent_key: str):
-        url = f"https://api.zotero.org/users/{self.zotero_user_id}/items/{parent_key}/children?itemType=attachment"
-        with requests.get(url, headers={"Authorization": f"Bearer {self.zotero_api_key}",
-                                                    "Accept": "application/json"}) as response:
-            response.raise_for_status()
-            return [ZoteroAttachment(**attachment) for attachment in response.json()]
+        attachments, _ = self._get_json(self.library_url(f"items/{parent_key}/children"), params={"itemType": "attachment"})
+        return [ZoteroAttachment(**attachment) for attachment in attachments]
     
-    def get_file(self, item_key: str):
-        url = f"https://api.zotero.org/users/{self.zotero_user_id}/items/{item_key}/file"
-        with requests.get(url, headers={"Authorization": f"Bearer {self.zotero_api_key}",
-                                                    "Accept": "application/json"}) as response:
+    def download_file(self, item_key: str, file):
+        '''
+        Stream an attachment file into an open binary file object, returning its content type
+        '''
+        with self._get(self.library_url(f"items/{item_key}/file"), stream=True) as response:
             response.raise_for_status()
-            if 'application/zip' in response.headers.get('Content-Type', ''):
-                return self._process_zip_file(response.content)
-            else:
-                raise ValueError("Expected HTML file, received: {}".format(response.headers['Content-Type']))
-    
-    def _process_zip_file(self, zip_content):
-        zip_file = BytesIO(zip_content)
-        with zipfile.ZipFile(zip_file, 'r') as z:
-            for filename in z.namelist():
-                if filename.endswith('.html'):
-                    with z.open(filename) as html_file:
-                        html_content = html_file.read().decode('utf-8')
-                        return html_content
-            raise ValueError("No HTML file found in the ZIP archive")
-    
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                file.write(chunk)
+            return response.headers.get('Content-Type', '')
 
-    def get_attachment_highlights_pdf(self, key: str):
-        url = f"https://api.zotero.org/users/{self.zotero_user_id}/items/{key}/children"
-        with requests.get(url, headers={"Authorization": f"Bearer {self.zotero_api_key}",
-                                                    "Accept": "application/json"}) as response:
-            response.raise_for_status()
+    def _open_zipped_html(self, z: zipfile.ZipFile):
+        for filename in z.namelist():
+            if filename.endswith('.html'):
+                return io.TextIOWrapper(z.open(filename), encoding='utf-8')
+        raise ValueError("No HTML file found in the ZIP archive")
 
-            highlights = []
-            for highlight in response.json():
-                if highlight.get('data', {}).get('annotationType') == 'highlight':
-                    highlights.append(ZoteroAttachmentHighlight(**highlight))
-            return highlights
+    def get_file(self, item_key: str):
+        with tempfile.TemporaryFile() as file:
+            content_type = self.download_file(item_key, file)
+            if 'application/zip' not in content_type:
+                raise ValueError("Expected HTML file, received: {}".format(content_type))
+            with zipfile.ZipFile(file, 'r') as z, self._open_zipped_html(z) as html_file:
+                return html_file.read()
 
-    def get_attachment_notes_pdf(self, key: str):
-        url = f"https://api.zotero.org/users/{self.zotero_user_id}/items/{key}/children"
-        with requests.get(url, headers={"Authorization": f"Bearer {self.zotero_api_key}",
-                                                    "Accept": "application/json"}) as response: 
+    def get_notebook_highlights(self, attachment: ZoteroAttachment) -> list[str]:
+        '''
+        Text of each highlight in a Kindle notebook attachment. The zipped notebook is
+        streamed to a temporary file and parsed incrementally; with a cache the extracted
+        highlights are kept per attachment md5 (or version) so an unchanged notebook is
+        not downloaded again.
+        '''
+        cache_key = f"kindle-notebook:{attachment.key}"
+        cache_version = attachment.data.md5 or (str(attachment.version) if attachment.version else None)
+        if self.cache and cache_version:
+            entry = self.cache.get(cache_key)
+            if entry is not None and entry['version'] == cache_version:
+                self.report.count('kindle_notebooks_cached')
+                return entry['body']
 
-            response.raise_for_status()
-            notes = []
-            for note in response.json():
-                if note.get('data', {}).get('annotationType') == 'note':
-                    notes.append(ZoteroAttachmentNote(**note))
-            return notes
+        with tempfile.TemporaryFile() as file:
+            content_type = self.download_file(attachment.key, file)
+            if 'application/zip' not in content_type:
+                raise ValueError("Expected HTML file, received: {}".format(content_type))
+            parser = KindleNotebookParser()
+            with zipfile.ZipFile(file, 'r') as z, self._open_zipped_html(z) as html_file:
+                while chunk := html_file.read(64 * 1024):
+                    parser.feed(chunk)
+            parser.close()
+
+        if self.cache and cache_version:
+            self.cache.set(cache_key, parser.highlights, {}, cache_version, None)
+        return parser.highlights
+
+    def get_attachment_highlights_pdf(self, key: str):
+        highlights, _ = self.annotations_from_children(self.get_attachment_children(key))
+        return highlights
+
+    def get_attachment_notes_pdf(self, key: str):
+        _, notes = self.annotations_from_children(self.get_attachment_children(key))
+        return notes
     
-    def get_attachment_annotations_kindle(self, parent_key, notebook, mtime):
-        soup = BeautifulSoup(notebook, 'html.parser')
-        text_elements = soup.find_all('div', class_='noteText')
-        highlights = []
-        for i, highlight in enumerate(text_elements):
-            highlights.append(
-                ZoteroAttachmentHighlight(
-                    key=f"{parent_key}-highlight-{i}",
-                    data=ZoteroAttachmentHighlightData(
-                        annotationText=highlight.get_text(),
-                        dateModified=mtime
-                    )
+    def kindle_highlights(self, parent_key: str, texts: list[str], mtime: str):
+        return [
+            ZoteroAttachmentHighlight(
+                key=f"{parent_key}-highlight-{i}",
+                data=ZoteroAttachmentHighlightData(
+                    annotationText=text,
+                    dateModified=mtime
                 )
             )
-        return highlights
+            for i, text in enumerate(texts)
+        ]
+
+    def get_attachment_annotations_kindle(self, parent_key, notebook, mtime):
+        parser = KindleNotebookParser()
+        parser.feed(notebook)
+        parser.close()
+        return self.kindle_highlights(parent_key, parser.highlights, mtime)
     
-    def get_attachment_annotations(self, parent_key: str):
-        attachments = self.get_attachment_items(parent_key)
+    def get_attachment_children(self, key: str):
+        children, _ = self._get_json(self.library_url(f"items/{key}/children"))
+        return children
+
+    def annotations_from_children(self, children: list[dict]):
+        highlights = []
+        notes = []
+        for child in children:
+            annotation_type = child.get('data', {}).get('annotationType')
+            if annotation_type == 'highlight':
+                highlights.append(ZoteroAttachmentHighlight(**child))
+            elif annotation_type == 'note':
+                notes.append(ZoteroAttachmentNote(**child))
+        return highlights, notes
 
+    def collect_attachment_annotations(self, attachments: list[ZoteroAttachment], get_children: Callable[[str], list[dict]]):
         notes = []
         annotations = []
         
         for attachment in attachments:
             if attachment.data.filename.endswith(".pdf"):
-                annotations.append(self.get_attachment_highlights_pdf(attachment.key))
-                notes.append(self.get_attachment_notes_pdf(attachment.key))
+                pdf_highlights, pdf_notes = self.annotations_from_children(get_children(attachment.key))
+                annotations.append(pdf_highlights)
+                notes.append(pdf_notes)
             elif attachment.data.filename.endswith("Notebook.html"):
-                notebook = self.get_file(attachment.key)
-                annotations.append(self.get_attachment_annotations_kindle(attachment.key, notebook, attachment.data.mtime))
+                texts = self.get_notebook_highlights(attachment)
+                annotations.append(self.kindle_highlights(attachment.key, texts, attachment.data.mtime))
         
         annotations = [item for sublist in annotations for item in sublist]
         notes = [item for sublist in notes for item in sublist]
 
         return annotations, notes
 
+    def get_attachment_annotations(self, parent_key: str):
+        attachments = self.get_attachment_items(parent_key)
+        return self.collect_attachment_annotations(attachments, self.get_attachment_children)
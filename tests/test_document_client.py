@@ -1,7 +1,8 @@
 import os
 from dotenv import load_dotenv
-from src.zotero_client import ZoteroClient
-from src.document_client import DocumentClient
+from src.zotero_client import ZoteroClient, ZoteroDocument, ZoteroNote
+from src.document_client import DocumentClient, Document
+from src.request_scheduler import RequestScheduler
 
 load_dotenv()
 
@@ -35,4 +36,217 @@ def test_sync_documents():
     
     graph_client.sync_documents()
     
-    assert os.path.exists('data/LPCXM5FY.json')
\ No newline at end of file
+    assert os.path.exists('data/LPCXM5FY.json')
+
+class FailingZoteroClient:
+    last_modified_version = 1
+
+    def get_item_versions(self, since=None):
+        return {'GOOD0001': 1, 'BAD00001': 1, 'GOOD0002': 1}
+
+    def count_items(self, item_type):
+        return 10000
+
+def test_sync_documents_isolates_failures(tmp_path):
+    document_client = DocumentClient(FailingZoteroClient(), str(tmp_path), str(tmp_path), max_workers=2)
+
+    def add_document(key):
+        if key.startswith('BAD'):
+            raise RuntimeError('boom')
+        (tmp_path / f'{key}.json').write_text('{}')
+
+    document_client.add_document = add_document
+    failed = document_client.sync_documents()
+
+    assert list(failed) == ['BAD00001']
+    assert (tmp_path / 'GOOD0001.json').exists()
+    assert (tmp_path / 'GOOD0002.json').exists()
+
+    assert document_client.read_library_version() is None
+
+
+class IncrementalZoteroClient:
+    last_modified_version = None
+
+    def get_item_versions(self, since=None):
+        self.last_modified_version = 5
+        if since == 5:
+            return {}
+        return {'CHANGED1': 5}
+
+    def get_deleted_items(self, since):
+        return ['DELETED1']
+
+    def count_items(self, item_type):
+        return 10000
+
+def test_sync_documents_incremental(tmp_path):
+    document_client = DocumentClient(IncrementalZoteroClient(), str(tmp_path), str(tmp_path))
+    document_client.write_library_version(3)
+    deleted = Document(key='DELETED1', version=1, title='A: title', abstract=None,
+                       collections=[], annotations=[], notes=[])
+    document_client.store.save(deleted)
+    (tmp_path / 'pages').mkdir()
+    (tmp_path / 'pages' / 'A_ title.md').write_text('')
+    added = []
+    document_client.add_document = added.append
+
+    document_client.sync_documents()
+    assert added == ['CHANGED1']
+    assert not (tmp_path / 'DELETED1.json').exists()
+    assert not (tmp_path / 'pages' / 'A_ title.md').exists()
+    assert document_client.read_library_version() == 5
+
+    document_client.sync_documents()
+    assert added == ['CHANGED1']
+
+
+def test_sync_documents_bulk(tmp_path):
+    zotero_client = ZoteroClient('0', '')
+    zotero_client.get_item_versions = lambda since=None: {'PARENT01': 7}
+    zotero_client.last_modified_version = 7
+    zotero_client.get_items = lambda keys: [{
+        'key': 'PARENT01', 'version': 7,
+        'data': {'itemType': 'journalArticle', 'title': 'A title', 'collections': [],
+                 'dateModified': '2024-01-01T00:00:00Z'}
+    }]
+    zotero_client.iter_all_items = lambda item_type: iter([
+        {'key': 'PDF00001', 'data': {'itemType': 'attachment', 'parentItem': 'PARENT01',
+                                     'filename': 'paper.pdf', 'dateModified': '2024-01-01T00:00:00Z'}},
+        {'key': 'NOTE0001', 'data': {'itemType': 'note', 'parentItem': 'PARENT01',
+                                     'note': '<p>A note</p>', 'dateModified': '2024-01-02T00:00:00Z'}},
+        {'key': 'ANNOT001', 'data': {'itemType': 'annotation', 'parentItem': 'PDF00001', 'annotationType': 'highlight',
+                                     'annotationText': ' A highlight ', 'dateModified': '2024-01-03T00:00:00Z'}},
+    ])
+    zotero_client.count_items = lambda item_type: 3
+    document_client = DocumentClient(zotero_client, str(tmp_path), str(tmp_path))
+
+    assert document_client.sync_documents() == {}
+
+    document = Document.model_validate_json((tmp_path / 'PARENT01.json').read_text())
+    assert [x.text for x in document.annotations] == ['A highlight']
+    assert [x.text for x in document.notes] == ['A note']
+
+
+def test_add_documents_reports_missing_items(tmp_path):
+    zotero_client = ZoteroClient('0', '')
+    zotero_client.get_items = lambda keys: []
+    document_client = DocumentClient(zotero_client, str(tmp_path), str(tmp_path))
+
+    failed = document_client.add_documents(['GONE0001'], {})
+
+    assert list(failed) == ['GONE0001']
+
+
+def test_write_document_reuses_blocks_of_unchanged_notes(tmp_path):
+    document_client = DocumentClient(ZoteroClient('0', ''), str(tmp_path), str(tmp_path))
+    zotero_doc = ZoteroDocument(key='PARENT01', version=7, data={
+        'title': 'A title', 'collections': [], 'dateModified': '2024-01-01T00:00:00Z'})
+
+    def child_note(version, html):
+        return ZoteroNote(key='NOTE0001', version=version, data={'note': html, 'dateModified': '2024-01-02T00:00:00Z'})
+
+    document_client.write_document(zotero_doc, [], [], [child_note(3, '<p>First</p><ul><li>Second</li></ul>')])
+    # Same version, so the cached blocks are used rather than the (impossible) new HTML
+    document_client.write_document(zotero_doc, [], [], [child_note(3, '<p>Changed</p>')])
+    assert [x.text for x in document_client.store.load('PARENT01').notes] == ['First', '- Second']
+    assert document_client.report.counters['notes_cached'] == 1
+
+    document_client.write_document(zotero_doc, [], [], [child_note(4, '<p>Changed</p>')])
+    assert [x.text for x in document_client.store.load('PARENT01').notes] == ['Changed']
+    assert document_client.report.counters['notes_parsed'] == 2
+
+
+class ResumableZoteroClient:
+    last_modified_version = None
+
+    def __init__(self):
+        self.scheduler = RequestScheduler()
+
+    def get_item_versions(self, since=None):
+        if since is None:
+            self.last_modified_version = 9
+            return {'OLD00001': 2, 'NEW00001': 9, 'MID00001': 5}
+        self.last_modified_version = 10
+        return {'NEWER001': 10}
+
+    def get_deleted_items(self, since):
+        return ['MID00001']
+
+    def count_items(self, item_type):
+        return 10000
+
+def test_sync_documents_resumes_in_priority_order_after_budget_runs_out(tmp_path):
+    zotero_client = ResumableZoteroClient()
+    document_client = DocumentClient(zotero_client, str(tmp_path), str(tmp_path), max_workers=1, max_requests=0)
+    synced = []
+
+    def add_document(key):
+        synced.append(key)
+        document_client.store.save(Document(key=key, version=zotero_client.last_modified_version,
+                                            title=key, abstract=None, collections=[], annotations=[], notes=[]))
+
+    document_client.add_document = add_document
+    assert document_client.sync_documents() == {}
+    assert synced == []
+    assert document_client.sync_pending()
+    assert document_client.read_library_version() is None
+    assert list(document_client.read_sync_cursor()[1]) == ['NEW00001', 'MID00001', 'OLD00001']
+    assert document_client.report.counters['documents_deferred'] == 3
+
+    # Items changed since the cursor come first, items deleted since are dropped
+    document_client.max_requests = None
+    progress = []
+    document_client.on_progress = lambda: progress.append(len(synced))
+    document_client.progress_every = 2
+    assert document_client.sync_documents() == {}
+    assert synced == ['NEWER001', 'NEW00001', 'OLD00001']
+    assert progress == [2, 3]
+    assert not document_client.sync_pending()
+    assert document_client.read_library_version() == 10
+
+
+class UnreachableZoteroClient:
+    def get_document(self, key):
+        raise ConnectionError('connection reset')
+
+def test_failed_update_keeps_document_and_page(tmp_path):
+    from src.graph_client import GraphClient
+    from src.keyword_client import KeywordClient
+    (tmp_path / 'pages').mkdir()
+    document_client = DocumentClient(UnreachableZoteroClient(), str(tmp_path), str(tmp_path))
+    document_client.store.save(Document(key='KEY00001', version=1, title='Kept', abstract=None, collections=[],
+                                        annotations=[{'text': 'A highlight', 'mtime': '2024-03-02T10:00:00Z'}], notes=[]))
+    template_path = os.path.join(os.path.dirname(__file__), '..', 'templates')
+    graph_client = GraphClient(str(tmp_path), str(tmp_path), template_path, KeywordClient(str(tmp_path), ['Accra']))
+    assert graph_client.sync_graph() == 1
+
+    failed = document_client.sync_documents_by_key(['KEY00001'], 1)
+    graph_client.sync_graph()
+
+    assert isinstance(failed['KEY00001'], ConnectionError)
+    assert 'KEY00001' in document_client.index
+    assert (tmp_path / 'pages' / 'Kept.md').exists()
+
+
+def test_budget_smaller_than_child_listing_still_makes_progress(tmp_path):
+    import math
+    from benchmarks.synthetic_library import SyntheticLibrary
+    from benchmarks.fake_zotero_server import FakeZoteroServer
+    from src.document_client import CHILD_ITEM_TYPES
+    library = SyntheticLibrary(200, seed=1)
+
+    with FakeZoteroServer(library) as server:
+        zotero_client = ZoteroClient('1', 'key', base_url=server.url,
+                                     scheduler=RequestScheduler(rate=1000, burst=100, base_delay=0.01))
+        assert math.ceil(zotero_client.count_items(CHILD_ITEM_TYPES) / 100) > 20
+        document_client = DocumentClient(zotero_client, str(tmp_path), None, max_workers=2, max_requests=20)
+
+        synced = []
+        for _ in range(2):
+            assert document_client.sync_documents() == {}
+            synced.append(len(document_client.index.keys()))
+
+    # Documents are fetched one by one within the budget rather than spending it all on listing children
+    assert 0 < synced[0] < synced[1] < 200
+    assert document_client.sync_pending()
@@ -0,0 +1,55 @@
+import json
+from src.document_index import DocumentIndex
+
+
+def document_json(key, version, title='A/B: title'):
+    return json.dumps({
+        'key': key, 'version': version, 'title': title, 'abstract': None, 'collections': [],
+        'annotations': [{'text': 'a', 'mtime': '2024-01-01T00:00:00Z'}], 'notes': []
+    })
+
+def test_write_and_delete_document(tmp_path):
+    index = DocumentIndex(str(tmp_path))
+    index.write_document('KEY00001', document_json('KEY00001', 3))
+
+    row = index.get('KEY00001')
+    assert row['version'] == 3
+    assert row['page_path'] == 'pages/A_B_ title.md'
+    assert row['annotation_count'] == 1
+    assert (tmp_path / 'KEY00001.json').exists()
+
+    index.delete_document('KEY00001')
+    assert 'KEY00001' not in index
+    assert not (tmp_path / 'KEY00001.json').exists()
+
+def test_reconcile_with_json_store(tmp_path):
+    (tmp_path / 'KEY00001.json').write_text(document_json('KEY00001', 1))
+    index = DocumentIndex(str(tmp_path))
+    index.write_document('KEY00002', document_json('KEY00002', 5))
+    (tmp_path / 'KEY00001.json').unlink()
+
+    index = DocumentIndex(str(tmp_path))
+
+    assert index.keys() == ['KEY00002']
+    assert index.versions() == {'KEY00002': 5}
+    assert index.changed_since(4) == ['KEY00002']
+    assert index.changed_since(5) == []
+
+def test_writes_in_a_transaction_commit_together(tmp_path):
+    index = DocumentIndex(str(tmp_path))
+    index.write_document('KEY00001', document_json('KEY00001', 3))
+
+    try:
+        with index.transaction():
+            index.set_page_inputs('KEY00001', 'hash')
+            index.set_page_file('KEY00001', 'pages/A_B_ title.md')
+            raise RuntimeError('render failed')
+    except RuntimeError:
+        pass
+    assert index.page_inputs() == {}
+    assert index.page_files() == {}
+
+    with index.transaction():
+        index.set_page_inputs('KEY00001', 'hash')
+        index.set_page_file('KEY00001', 'pages/A_B_ title.md')
+    assert index.page_inputs() == {'KEY00001': 'hash'}
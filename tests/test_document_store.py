@@ -0,0 +1,36 @@
+from src.document_store import Document, DocumentHighlight, DocumentNote, DocumentStore
+
+
+def make_document(key, version=1):
+    return Document(
+        key=key, version=version, title=f"Study {key}", abstract=None, collections=[],
+        annotations=[DocumentHighlight(text='Accra is a city', mtime='2024-03-02T10:00:00Z')],
+        notes=[DocumentNote(text='A note', mtime='2024-03-02T11:00:00Z')]
+    )
+
+def test_save_and_load_round_trip(tmp_path):
+    store = DocumentStore(str(tmp_path))
+    document = make_document('KEY00001', 4)
+    store.save(document)
+
+    assert store.load('KEY00001') == document
+    row = store.index.get('KEY00001')
+    assert row['version'] == 4
+    assert row['annotation_count'] == 2
+
+    store.delete('KEY00001')
+    assert 'KEY00001' not in store.index
+
+def test_export_and_import_jsonl(tmp_path):
+    (tmp_path / 'source').mkdir()
+    source = DocumentStore(str(tmp_path / 'source'))
+    documents = [make_document(f"KEY{i:05d}") for i in range(5)]
+    source.save_many(documents)
+    assert source.export_jsonl(str(tmp_path / 'library.jsonl.gz')) == 5
+
+    (tmp_path / 'target').mkdir()
+    target = DocumentStore(str(tmp_path / 'target'))
+    assert target.import_jsonl(str(tmp_path / 'library.jsonl.gz'), batch_size=2) == 5
+
+    assert list(target.load_many(target.index.keys())) == documents
+    assert target.index.content_hashes() == source.index.content_hashes()
@@ -0,0 +1,45 @@
+from benchmarks.synthetic_library import SyntheticLibrary
+from benchmarks.fake_zotero_server import FakeZoteroServer
+from src.zotero_client import ZoteroClient
+from src.request_scheduler import RequestScheduler
+from src.document_client import DocumentClient
+
+
+def sync(library, tmp_path, **server_options):
+    with FakeZoteroServer(library, **server_options) as server:
+        scheduler = RequestScheduler(rate=1000, burst=100, base_delay=0.01)
+        zotero_client = ZoteroClient('1', 'key', base_url=server.url, scheduler=scheduler)
+        document_client = DocumentClient(zotero_client, str(tmp_path), str(tmp_path))
+        failed = document_client.sync_documents()
+        return failed, document_client, server
+
+def test_sync_synthetic_library(tmp_path):
+    library = SyntheticLibrary(30, annotations_per_pdf=4, kindle_every=10)
+
+    failed, document_client, server = sync(library, tmp_path, throttle_every=7, retry_after=0)
+
+    assert failed == {}
+    assert sorted(document_client.index.keys()) == sorted(library.top_level_keys())
+    assert server.requests_by_endpoint['items/{key}/file'] >= len(library.files) > 0
+
+    library.delete(library.top_level_keys()[:2])
+    failed, document_client, server = sync(library, tmp_path)
+    assert failed == {}
+    assert len(document_client.index.keys()) == 28
+
+    failed, document_client, server = sync(library, tmp_path)
+    assert server.request_count == 1
+
+def test_kindle_notebooks_are_cached_by_md5(tmp_path):
+    library = SyntheticLibrary(4, annotations_per_pdf=3, kindle_every=2)
+    notebook_key = next(iter(library.files))
+
+    with FakeZoteroServer(library) as server:
+        zotero_client = ZoteroClient('1', 'key', cache_path=str(tmp_path), base_url=server.url)
+        attachment = zotero_client.get_attachment_items(library.items[notebook_key]['data']['parentItem'])[0]
+        first = zotero_client.get_notebook_highlights(attachment)
+        second = zotero_client.get_notebook_highlights(attachment)
+
+    assert len(first) == 3
+    assert first == second
+    assert server.requests_by_endpoint['items/{key}/file'] == 1
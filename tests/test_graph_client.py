@@ -1,4 +1,5 @@
 import os
+import json
 from dotenv import load_dotenv
 from src.graph_client import GraphClient
 
@@ -8,3 +9,162 @@ def test_write_document_page():
     graph_client = GraphClient(os.getenv('DATA_PATH'), os.getenv('GRAPH_PATH'), os.getenv('TEMPLATE_PATH'))
     document = graph_client.write_document_page('LPCXM5FY')
     assert os.path.exists(f"{os.getenv('GRAPH_PATH')}/pages/Association between mobility, non-pharmaceutical interventions, and COVID-19 transmission in Ghana: A modelling study using mobile phone data.md")
+
+
+def make_graph_client(tmp_path, keywords):
+    from src.keyword_client import KeywordClient
+    data_path = tmp_path / 'data'
+    graph_path = tmp_path / 'graph'
+    data_path.mkdir(exist_ok=True)
+    (graph_path / 'pages').mkdir(parents=True, exist_ok=True)
+    (graph_path / 'journals').mkdir(exist_ok=True)
+    keyword_client = KeywordClient(str(data_path), keywords)
+    template_path = os.path.join(os.path.dirname(__file__), '..', 'templates')
+    return GraphClient(str(data_path), str(graph_path), template_path, keyword_client)
+
+def write_test_document(graph_client, key, title, highlight):
+    graph_client.index.write_document(key, json.dumps({
+        'key': key, 'version': 1, 'title': title, 'abstract': 'A study of Accra.', 'collections': [],
+        'annotations': [{'text': highlight, 'mtime': '2024-03-02T10:00:00Z'}], 'notes': []
+    }))
+
+def test_sync_graph_only_writes_changed_pages(tmp_path):
+    graph_client = make_graph_client(tmp_path, ['Accra'])
+    write_test_document(graph_client, 'KEY00001', 'First', 'Accra is a city')
+    write_test_document(graph_client, 'KEY00002', 'Second', 'Kumasi is a city')
+
+    assert graph_client.sync_graph() == 2
+    page = tmp_path / 'graph' / 'pages' / 'First.md'
+    assert '[[Accra]] is a city' in page.read_text()
+
+    assert graph_client.sync_graph() == 0
+
+    write_test_document(graph_client, 'KEY00002', 'Second', 'Tamale is a city')
+    assert graph_client.sync_graph() == 1
+
+    # A new keyword set re-renders every page but only rewrites pages whose text changed
+    graph_client = make_graph_client(tmp_path, ['Accra', 'Tamale'])
+    assert graph_client.sync_graph() == 1
+
+def test_sync_graph_renders_in_parallel(tmp_path):
+    graph_client = make_graph_client(tmp_path, ['Accra'])
+    graph_client.processes = 2
+    for i in range(6):
+        write_test_document(graph_client, f'KEY0000{i}', f'Title {i}', 'Accra is a city')
+
+    assert graph_client.sync_graph() == 6
+    assert graph_client.render_document_page('KEY00003') == (tmp_path / 'graph' / 'pages' / 'Title 3.md').read_text()
+
+def test_sync_graph_renders_in_spawned_processes(tmp_path):
+    import multiprocessing
+    graph_client = make_graph_client(tmp_path, ['Accra'])
+    graph_client.processes = 2
+    graph_client.mp_context = multiprocessing.get_context('spawn')
+    for i in range(3):
+        write_test_document(graph_client, f'KEY0000{i}', f'Title {i}', 'Accra is a city')
+
+    assert graph_client.sync_graph() == 3
+    assert '[[Accra]] is a city' in (tmp_path / 'graph' / 'pages' / 'Title 1.md').read_text()
+
+def test_journal_pages_only_for_days_with_activity(tmp_path):
+    graph_client = make_graph_client(tmp_path, ['Accra'])
+    write_test_document(graph_client, 'KEY00001', 'First', 'Accra is a city')
+    graph_client.index.write_document('KEY00002', json.dumps({
+        'key': 'KEY00002', 'version': 1, 'title': 'Second', 'abstract': None, 'collections': [],
+        'annotations': [{'text': 'Old highlight', 'mtime': '2019-07-14T09:00:00Z', 'key': 'ANNOT001'}],
+        'notes': [{'text': 'Old note', 'mtime': '2019-07-14T18:00:00Z', 'key': 'NOTE0001'}]
+    }))
+    journals = tmp_path / 'graph' / 'journals'
+    (journals / '2024_03_02.md').write_text('my own notes')
+
+    graph_client.sync_graph()
+    assert graph_client.index.annotations_on('2019-07-14') == [('KEY00002', 'ANNOT001'), ('KEY00002', 'NOTE0001')]
+
+    assert graph_client.backfill_journal_pages() == 1
+    assert sorted(os.listdir(journals)) == ['2019_07_14.md', '2024_03_02.md']
+    assert 'Jul 14th, 2019' in (journals / '2019_07_14.md').read_text()
+    assert (journals / '2024_03_02.md').read_text() == 'my own notes'
+    assert graph_client.backfill_journal_pages() == 0
+
+    graph_client.store.delete('KEY00002')
+    assert graph_client.index.annotation_days() == ['2024-03-02']
+
+def test_keyword_pages_are_rewritten_only_when_occurrences_change(tmp_path):
+    graph_client = make_graph_client(tmp_path, ['Accra', 'Kumasi'])
+    keyword_client = graph_client.keyword_client
+    graph_path = str(tmp_path / 'graph')
+    pages = tmp_path / 'graph' / 'pages'
+    (pages / 'Kumasi.md').write_text('my own page')
+    write_test_document(graph_client, 'KEY00001', 'First', 'Accra is a city')
+    write_test_document(graph_client, 'KEY00002', 'Second', 'Accra and Kumasi')
+
+    graph_client.sync_graph()
+    assert keyword_client.write_keyword_pages(graph_path) == 1
+    assert (pages / 'Accra.md').read_text() == (
+        "type:: Keyword\n\n"
+        "- [[First]]\n  - 📖 [[Accra]] is a city\n"
+        "- [[Second]]\n  - 📖 [[Accra]] and [[Kumasi]]\n"
+    )
+    assert (pages / 'Kumasi.md').read_text() == 'my own page'
+    assert keyword_client.write_keyword_pages(graph_path) == 0
+
+    write_test_document(graph_client, 'KEY00002', 'Second', 'Only Kumasi now')
+    graph_client.sync_graph()
+    assert graph_client.index.stale_keywords() == ['Accra', 'Kumasi']
+    assert keyword_client.write_keyword_pages(graph_path) == 1
+    assert 'Second' not in (pages / 'Accra.md').read_text()
+
+    graph_client.store.delete('KEY00001')
+    assert keyword_client.write_keyword_pages(graph_path) == 0
+    assert not (pages / 'Accra.md').exists()
+
+def test_retitled_and_deleted_documents_leave_no_orphan_pages(tmp_path):
+    graph_client = make_graph_client(tmp_path, ['Accra'])
+    pages = tmp_path / 'graph' / 'pages'
+    write_test_document(graph_client, 'KEY00001', 'Old title', 'Accra is a city')
+    write_test_document(graph_client, 'KEY00002', 'Deleted', 'Accra is a city')
+    (pages / 'Mine.md').write_text('my own page')
+    graph_client.sync_graph()
+    assert graph_client.index.page_files() == {'KEY00001': 'pages/Old title.md', 'KEY00002': 'pages/Deleted.md'}
+
+    # Rendering moves the page of a retitled document, whose content is otherwise unchanged
+    write_test_document(graph_client, 'KEY00001', 'New title', 'Accra is a city')
+    assert graph_client.sync_graph() == 0
+    assert sorted(os.listdir(pages)) == ['Deleted.md', 'Mine.md', 'New title.md']
+
+    # The sweep removes pages of documents deleted behind the graph's back
+    graph_client.store.delete('KEY00002')
+    graph_client.sync_graph()
+    assert sorted(os.listdir(pages)) == ['Mine.md', 'New title.md']
+    assert graph_client.index.page_files() == {'KEY00001': 'pages/New title.md'}
+
+    # A sweep alone also moves pages of retitled documents
+    write_test_document(graph_client, 'KEY00001', 'Third title', 'Accra is a city')
+    assert graph_client.collect_orphan_pages() == 1
+    assert sorted(os.listdir(pages)) == ['Mine.md', 'Third title.md']
+
+def test_pages_render_from_stored_records_and_cached_links(tmp_path):
+    from src.document_store import Document
+    graph_client = make_graph_client(tmp_path, ['Accra'])
+    write_test_document(graph_client, 'KEY00001', 'First', 'Accra is a city')
+    matcher = graph_client.keyword_client.matcher
+    linked = []
+    link_keywords = matcher.link_keywords
+    matcher.link_keywords = lambda text: linked.append(text) or link_keywords(text)
+
+    # Written behind the store's back, so the record is built while rendering
+    graph_client.sync_graph()
+    assert graph_client.report.counters['page_records_built'] == 1
+    assert linked == ['A study of Accra.', 'Accra is a city']
+
+    # Saving through the store records the sorted, formatted annotations, and only the new text is linked
+    document = graph_client.store.load('KEY00001')
+    document.notes.append({'text': 'Back in Accra', 'mtime': '2024-03-01T09:00:00Z', 'key': 'NOTE0001'})
+    graph_client.store.save(Document.model_validate(document.model_dump()))
+    linked.clear()
+    assert graph_client.sync_graph() == 1
+    assert graph_client.report.counters['page_records_built'] == 1
+    assert linked == ['Back in Accra']
+    page = (tmp_path / 'graph' / 'pages' / 'First.md').read_text()
+    assert page.index('Back in [[Accra]]') < page.index('[[Accra]] is a city')
+    assert 'mtime:: Mar 1st, 2024' in page
@@ -0,0 +1,26 @@
+from src.item_spool import ItemSpool
+
+
+def test_spool_groups_items_by_parent():
+    items = [
+        {'key': 'PDF00001', 'data': {'itemType': 'attachment', 'parentItem': 'PARENT01'}},
+        {'key': 'PARENT01', 'data': {'itemType': 'journalArticle'}},
+        {'key': 'ANNOT001', 'data': {'itemType': 'annotation', 'parentItem': 'PDF00001'}},
+        {'key': 'NOTE0001', 'data': {'itemType': 'note', 'parentItem': 'PARENT01'}},
+    ]
+    with ItemSpool(chunk_size=2) as spool:
+        assert spool.add(iter(items)) == 3
+        assert [item['key'] for item in spool.get('PARENT01')] == ['PDF00001', 'NOTE0001']
+        assert spool.get('PDF00001') == [items[2]]
+        assert spool.get('MISSING1', []) == []
+
+def test_annotated_parents_have_notes_or_annotated_attachments():
+    items = [
+        {'key': 'PDF00001', 'data': {'itemType': 'attachment', 'parentItem': 'HIGHLIT1'}},
+        {'key': 'ANNOT001', 'data': {'itemType': 'annotation', 'parentItem': 'PDF00001'}},
+        {'key': 'NOTE0001', 'data': {'itemType': 'note', 'parentItem': 'NOTED001'}},
+        {'key': 'PDF00002', 'data': {'itemType': 'attachment', 'parentItem': 'UNREAD01'}},
+    ]
+    with ItemSpool() as spool:
+        spool.add(items)
+        assert spool.annotated_parents() == {'HIGHLIT1', 'NOTED001'}
@@ -0,0 +1,43 @@
+import json
+import spacy
+from src.keyword_client import KeywordClient
+
+
+def write_document(keyword_client, key, abstract):
+    keyword_client.index.write_document(key, json.dumps({
+        'key': key, 'version': 1, 'title': key, 'abstract': abstract, 'collections': [],
+        'annotations': [], 'notes': []
+    }))
+
+def entity_ruler(*names):
+    nlp = spacy.blank('en')
+    ruler = nlp.add_pipe('entity_ruler')
+    ruler.add_patterns([{'label': 'GPE', 'pattern': name} for name in names])
+    return nlp
+
+def test_detect_keywords_caches_entities_per_document(tmp_path):
+    keyword_client = KeywordClient(str(tmp_path), ['placeholder'])
+    write_document(keyword_client, 'KEY00001', 'Accra and Kumasi.')
+    write_document(keyword_client, 'KEY00002', 'Accra and Tamale.')
+    keyword_client._nlp = entity_ruler('Accra', 'Kumasi', 'Tamale')
+
+    assert keyword_client.detect_keywords() == {'Accra'}
+
+    # Unchanged documents are read from the cache, only the changed one is processed
+    write_document(keyword_client, 'KEY00002', 'Kumasi and Tamale.')
+    keyword_client._nlp = entity_ruler('Kumasi')
+
+    assert keyword_client.detect_keywords() == {'Kumasi'}
+    assert keyword_client.index.entity_counts()['KEY00002'][1] == {'Kumasi': 1}
+
+def test_extract_document_entities_streams_counts_in_key_order(tmp_path):
+    keyword_client = KeywordClient(str(tmp_path), ['placeholder'])
+    write_document(keyword_client, 'KEY00001', 'Accra and Accra.')
+    write_document(keyword_client, 'KEY00002', None)
+    write_document(keyword_client, 'KEY00003', 'Kumasi.')
+    keyword_client._nlp = entity_ruler('Accra', 'Kumasi')
+
+    counts = keyword_client.extract_document_entities(['KEY00001', 'KEY00002', 'KEY00003'])
+
+    assert next(counts) == ('KEY00001', {'Accra': 2})
+    assert list(counts) == [('KEY00002', {}), ('KEY00003', {'Kumasi': 1})]
@@ -0,0 +1,25 @@
+from src.keyword_matcher import KeywordMatcher
+
+
+def test_link_is_case_insensitive_and_keeps_original_text():
+    matcher = KeywordMatcher({'Ghana', 'world health organization'})
+    assert matcher.link('ghana and the World Health Organization') == '[[ghana]] and the [[World Health Organization]]'
+
+def test_link_respects_word_boundaries():
+    matcher = KeywordMatcher({'COVID'})
+    assert matcher.link('COVID19 and COVID-19 and xCOVID') == 'COVID19 and [[COVID]]-19 and xCOVID'
+
+def test_link_prefers_longest_match():
+    matcher = KeywordMatcher({'New York', 'New York City', 'York'})
+    assert matcher.link('New York City, New York and York') == '[[New York City]], [[New York]] and [[York]]'
+
+def test_link_with_no_keywords_returns_text():
+    assert KeywordMatcher([]).link('Nothing to link') == 'Nothing to link'
+
+def test_link_many():
+    matcher = KeywordMatcher({'Accra'})
+    assert matcher.link_many(['Accra', 'Kumasi']) == ['[[Accra]]', 'Kumasi']
+
+def test_link_keywords_returns_matched_keywords():
+    matcher = KeywordMatcher({'Ghana', 'Accra'})
+    assert matcher.link_keywords('ghana, Accra and GHANA') == ('[[ghana]], [[Accra]] and [[GHANA]]', ['Ghana', 'Accra'])
@@ -0,0 +1,51 @@
+import pytest
+from benchmarks.synthetic_library import SyntheticLibrary
+from benchmarks.fake_zotero_server import FakeZoteroServer
+from src.zotero_client import ZoteroClient
+from src.request_scheduler import RequestScheduler
+from src.document_client import DocumentClient
+from src.library_sync import LibrarySync, parse_libraries
+
+
+def test_parse_libraries():
+    assert parse_libraries('users/123, groups/456,') == [('users', '123'), ('groups', '456')]
+    with pytest.raises(ValueError):
+        parse_libraries('teams/1')
+
+def test_group_library_url():
+    assert ZoteroClient('456', '', library_type='groups').library_url('items') == 'https://api.zotero.org/groups/456/items'
+
+def test_libraries_sync_in_parallel_and_merge_shared_papers(tmp_path):
+    # Both libraries are generated from the same seed, so their first three papers are the same
+    personal = SyntheticLibrary(3, seed=1)
+    group = SyntheticLibrary(5, seed=1)
+    scheduler = RequestScheduler(rate=1000, burst=100, base_delay=0.01)
+    graph_path = tmp_path / 'graph' / 'pages'
+    graph_path.mkdir(parents=True)
+
+    with FakeZoteroServer(personal) as personal_server, FakeZoteroServer(group) as group_server:
+        clients = {}
+        for name, server in (('users_1', personal_server), ('groups_2', group_server)):
+            library_path = tmp_path / 'data' / 'libraries' / name
+            library_path.mkdir(parents=True)
+            zotero_client = ZoteroClient('1', 'key', base_url=server.url, scheduler=scheduler)
+            clients[name] = DocumentClient(zotero_client, str(library_path), None)
+        library_sync = LibrarySync(clients, str(tmp_path / 'data'), str(tmp_path / 'graph'))
+
+        assert library_sync.sync_documents() == {}
+        assert len(library_sync.index.keys()) == 5
+        first = personal.top_level_keys()[0]
+        assert len(library_sync.store.load(first).annotations) == len(clients['users_1'].store.load(first).annotations)
+        assert library_sync.merge() == 0
+
+        # Deleting a shared paper from one library keeps it, deleting the last copy removes it and its page
+        only_in_group = group.top_level_keys()[4]
+        page = tmp_path / 'graph' / library_sync.index.page_path(only_in_group)
+        page.write_text('page')
+        personal.delete([first])
+        group.delete([only_in_group])
+        assert library_sync.sync_documents() == {}
+
+    assert first in library_sync.index
+    assert only_in_group not in library_sync.index
+    assert not page.exists()
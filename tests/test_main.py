@@ -0,0 +1,52 @@
+import os
+import sys
+import json
+import time
+import subprocess
+from benchmarks.synthetic_library import SyntheticLibrary
+from benchmarks.fake_zotero_server import FakeZoteroServer
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'main.py')
+HEAVY_MODULES = ['spacy', 'jinja2', 'bs4']
+
+# Runs a command the way `python src/main.py` would, then reports which heavy modules got loaded
+RUN_AND_LIST_MODULES = f'''
+import sys, json, runpy
+sys.argv = ['main.py'] + sys.argv[1:]
+sys.path.insert(0, {os.path.dirname(MAIN)!r})
+runpy.run_path({MAIN!r}, run_name='__main__')
+print(json.dumps([name for name in {HEAVY_MODULES!r} if name in sys.modules]))
+'''
+
+def run(args, env=None):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', RUN_AND_LIST_MODULES, *args], capture_output=True, text=True,
+                            env={**os.environ, **(env or {})}, timeout=60)
+    assert result.returncode == 0, result.stderr
+    return result.stdout.strip().splitlines(), time.perf_counter() - start
+
+
+def test_sync_docs_help_is_fast():
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, MAIN, 'sync-docs', '--help'], capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0
+    assert 'usage: main.py sync-docs' in result.stdout
+    assert time.perf_counter() - start < 1.0
+
+
+def test_noop_sync_docs_does_not_load_nlp_or_templates(tmp_path):
+    library = SyntheticLibrary(5, annotations_per_pdf=2)
+    for path in ('data', 'graph/pages', 'graph/journals'):
+        os.makedirs(tmp_path / path)
+    with FakeZoteroServer(library) as server:
+        env = {'ZOTERO_BASE_URL': server.url, 'ZOTERO_USER_ID': '1', 'ZOTERO_API_KEY': 'key',
+               'DATA_PATH': str(tmp_path / 'data'), 'GRAPH_PATH': str(tmp_path / 'graph'),
+               'REPORT_PATH': str(tmp_path / 'report.json')}
+        run(['sync-docs'], env)
+        output, seconds = run(['sync-docs'], env)
+
+    assert json.loads(output[-1]) == []
+    assert seconds < 1.0
+    report = json.loads((tmp_path / 'report.json').read_text())
+    assert report['counters'].get('documents_added', 0) == 0
+    assert list(report['stages']) == ['sync_documents']
@@ -0,0 +1,63 @@
+import requests
+from src.request_scheduler import RequestScheduler
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def close(self):
+        pass
+
+def test_execute_retries_throttled_requests():
+    scheduler = RequestScheduler(max_concurrency=4, base_delay=0.01)
+    responses = iter([
+        FakeResponse(429, {'Retry-After': '0'}),
+        FakeResponse(503),
+        FakeResponse(200),
+    ])
+
+    response = scheduler.execute(lambda: next(responses))
+
+    assert response.status_code == 200
+    metrics = scheduler.metrics()
+    assert metrics['requests'] == 3
+    assert metrics['retries'] == 2
+    assert metrics['throttled'] == 2
+    assert metrics['concurrency'] == 1
+
+def test_execute_returns_last_response_when_retries_exhausted():
+    scheduler = RequestScheduler(max_retries=1, base_delay=0.01)
+    response = scheduler.execute(lambda: FakeResponse(429, {'Retry-After': '0'}))
+    assert response.status_code == 429
+    assert scheduler.metrics()['retries'] == 1
+
+def test_execute_honours_backoff_header():
+    scheduler = RequestScheduler()
+    responses = iter([FakeResponse(200, {'Backoff': '0.2'}), FakeResponse(200)])
+    scheduler.execute(lambda: next(responses))
+    scheduler.execute(lambda: next(responses))
+    assert scheduler.metrics()['wait_seconds'] >= 0.15
+
+def test_concurrency_recovers_after_successes():
+    scheduler = RequestScheduler(max_concurrency=2, increase_after=2, base_delay=0.01)
+    responses = iter([FakeResponse(429, {'Retry-After': '0'})] + [FakeResponse(200)] * 3)
+    for _ in range(3):
+        scheduler.execute(lambda: next(responses))
+    assert scheduler.metrics()['concurrency'] == 2
+
+def test_connection_error_retries_count_as_waiting():
+    scheduler = RequestScheduler(base_delay=0.05)
+    attempts = []
+
+    def send():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise requests.ConnectionError()
+        return FakeResponse(200)
+
+    assert scheduler.execute(send).status_code == 200
+    metrics = scheduler.metrics()
+    assert metrics['retries'] == 1
+    assert metrics['wait_seconds'] > 0
@@ -0,0 +1,18 @@
+import json
+from src.run_report import RunReport
+
+
+def test_report_collects_stages_counters_and_requests(tmp_path):
+    report = RunReport(profile_path=str(tmp_path / 'profiles'))
+    with report.stage('sync_documents'):
+        report.count('documents_added', 2)
+        report.record_request('items/ABCD1234/children', 100)
+        report.record_request('items/EFGH5678/children', 50, cache_hit=True)
+
+    report.write(str(tmp_path / 'report.json'))
+    data = json.loads((tmp_path / 'report.json').read_text())
+
+    assert 'sync_documents' in data['stages']
+    assert data['counters'] == {'documents_added': 2}
+    assert data['http'] == {'items/{key}/children': {'requests': 2, 'bytes': 150, 'cache_hits': 1}}
+    assert (tmp_path / 'profiles' / 'sync_documents.prof').exists()
@@ -0,0 +1,30 @@
+import pytest
+from src.sync_budget import SyncBudget
+
+
+class CountingScheduler:
+    def __init__(self):
+        self.requests = 0
+
+    def metrics(self):
+        return {'requests': self.requests}
+
+def test_take_stops_once_requests_are_spent():
+    scheduler = CountingScheduler()
+    scheduler.requests = 7
+    budget = SyncBudget(max_requests=5, scheduler=scheduler)
+    items = iter(range(10))
+
+    for item in budget.take(items):
+        scheduler.requests += 2
+
+    # Requests made before the budget was created don't count, untaken items stay in the iterator
+    assert list(items) == [3, 4, 5, 6, 7, 8, 9]
+
+def test_time_budget():
+    assert list(SyncBudget(max_seconds=0).take([1, 2])) == []
+    assert list(SyncBudget().take([1, 2])) == [1, 2]
+
+def test_request_budget_needs_a_scheduler():
+    with pytest.raises(ValueError):
+        SyncBudget(max_requests=10)
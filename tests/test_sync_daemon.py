@@ -0,0 +1,62 @@
+from src.sync_daemon import SyncDaemon
+
+
+class StubDocumentClient:
+    def __init__(self):
+        self.version = 1
+        self.changes = [True, False]
+
+    def read_library_version(self):
+        return self.version
+
+    def sync_pending(self):
+        return False
+
+    def sync_documents(self):
+        if self.changes.pop(0):
+            self.version += 1
+        return {}
+
+class StubKeywordClient:
+    def __init__(self):
+        self.keywords = set()
+
+    def detect_keywords(self):
+        return {'Accra'}
+
+    def set_keywords(self, keywords):
+        self.keywords = keywords
+
+    def write_keyword_pages(self, graph_path):
+        pass
+
+class StubGraphClient:
+    def __init__(self):
+        self.syncs = 0
+        self.graph_path = 'graph'
+
+    def sync_graph(self):
+        self.syncs += 1
+        return 1
+
+    def backfill_journal_pages(self):
+        pass
+
+def test_run_once_only_renders_when_library_changed():
+    graph_client = StubGraphClient()
+    keyword_client = StubKeywordClient()
+    daemon = SyncDaemon(StubDocumentClient(), keyword_client, graph_client)
+
+    assert daemon.run_once() is True
+    assert daemon.run_once() is False
+    assert graph_client.syncs == 1
+    assert keyword_client.keywords == {'Accra'}
+
+def test_trigger_file_ends_wait(tmp_path):
+    trigger = tmp_path / 'sync-now'
+    trigger.write_text('')
+    daemon = SyncDaemon(None, None, None, interval=30, trigger_path=str(trigger))
+
+    daemon.wait()
+
+    assert not trigger.exists()
@@ -1,9 +1,15 @@
 import pytest
 import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlparse
 from dotenv import load_dotenv
 from src.zotero_client import (
     ZoteroClient,
-    ZoteroAttachment
+    ZoteroAttachment,
+    note_blocks
 )
 
 load_dotenv()
@@ -53,4 +59,141 @@ def test_get_attachment_annotations_kindle():
     parent_key = 'GP7D5BSE'
     annotations, notes = zotero_client.get_attachment_annotations(parent_key)
     assert type(annotations) == list
-    assert type(notes) == list
\ No newline at end of file
+    assert type(notes) == list
+
+class FakeResponse:
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        self.content = json.dumps(body).encode('utf-8') if body is not None else b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(self.status_code)
+
+class FakeSession:
+    def __init__(self):
+        self.requests = []
+
+    def get(self, url, params=None, headers=None, stream=False):
+        self.requests.append((url, headers))
+        if headers.get('If-Modified-Since-Version') == '10':
+            return FakeResponse(304)
+        return FakeResponse(200, [{'key': 'ABCD1234'}], {'Last-Modified-Version': '10'})
+
+def test_get_json_revalidates_cached_responses(tmp_path):
+    zotero_client = ZoteroClient('0', '', cache_path=str(tmp_path))
+    zotero_client.session = FakeSession()
+
+    assert zotero_client.get_attachment_children('ABCD1234') == [{'key': 'ABCD1234'}]
+    assert zotero_client.get_attachment_children('ABCD1234') == [{'key': 'ABCD1234'}]
+    assert zotero_client.session.requests[0][1] == {}
+    assert zotero_client.session.requests[1][1] == {'If-Modified-Since-Version': '10'}
+
+def test_get_json_skips_cache_for_one_off_urls(tmp_path):
+    zotero_client = ZoteroClient('0', '', cache_path=str(tmp_path))
+    zotero_client.session = FakeSession()
+
+    zotero_client.get_items(['ABCD1234'])
+    assert os.listdir(tmp_path) == []
+
+def test_report_endpoints_without_library_prefix():
+    for library_type in ('users', 'groups'):
+        zotero_client = ZoteroClient('456', '', library_type=library_type)
+        zotero_client.session = FakeSession()
+
+        zotero_client.get_attachment_children('ABCD1234')
+        assert list(zotero_client.report.http) == ['items/{key}/children']
+
+class BlockingSession(FakeSession):
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def get(self, url, params=None, headers=None, stream=False):
+        self.release.wait()
+        return super().get(url, params, headers, stream)
+
+def test_get_json_shares_in_flight_requests():
+    zotero_client = ZoteroClient('0', '')
+    zotero_client.session = BlockingSession()
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(zotero_client.get_attachment_children, 'ABCD1234') for _ in range(4)]
+        time.sleep(0.1)
+        zotero_client.session.release.set()
+        results = [future.result() for future in futures]
+
+    assert results == [[{'key': 'ABCD1234'}]] * 4
+    assert len(zotero_client.session.requests) == 1
+
+
+class PagedSession:
+    def __init__(self, n_items):
+        self.n_items = n_items
+        self.requests = []
+
+    def get(self, url, params=None, headers=None, stream=False):
+        params = dict(parse_qsl(urlparse(url).query))
+        self.requests.append(params)
+        if 'itemKey' in params:
+            keys = params['itemKey'].split(',')
+            return FakeResponse(200, [{'key': key} for key in keys])
+        start, limit = int(params['start']), int(params['limit'])
+        page = [{'key': str(i)} for i in range(start, min(start + limit, self.n_items))]
+        return FakeResponse(200, page, {'Total-Results': str(self.n_items)})
+
+def test_get_items_batches_keys():
+    zotero_client = ZoteroClient('0', '')
+    zotero_client.session = PagedSession(0)
+    keys = [f'KEY{i:05d}' for i in range(120)]
+
+    items = zotero_client.get_items(keys)
+
+    assert [item['key'] for item in items] == keys
+    assert [len(r['itemKey'].split(',')) for r in zotero_client.session.requests] == [50, 50, 20]
+
+def test_get_all_items_pages_until_total_results():
+    zotero_client = ZoteroClient('0', '')
+    zotero_client.session = PagedSession(250)
+
+    items = zotero_client.get_all_items('attachment')
+
+    assert len(items) == 250
+    assert [r['start'] for r in zotero_client.session.requests] == ['0', '100', '200']
+
+def test_kindle_notebook_parser_handles_stray_headings():
+    zotero_client = ZoteroClient('0', '')
+    notebook = (
+        "<div class='bodyContainer'>"
+        "<h3 class='noteHeading'>Highlight - Location 1</h3><div class='noteText'>First &amp; best</div>"
+        "<h3 class='noteHeading'>Highlight - Location 2</h3><div class='noteText'>Second</h3>"
+        "<h3 class='noteHeading'>Note - Location 3</h3><div class='noteText'> Third </div>"
+        "</div>"
+    )
+    highlights = zotero_client.get_attachment_annotations_kindle('NOTEBOOK', notebook, '2024-01-01T00:00:00Z')
+    assert [h.data.text for h in highlights] == ['First & best', 'Second', 'Third']
+
+def test_note_blocks_keep_paragraphs_and_lists():
+    note = (
+        "<h1>Notes</h1><p>First  <b>bold</b>\n paragraph</p><p>Fish &amp; chips</p>"
+        "<ul><li><p>Point</p></li><li>Parent<ul><li>Child</li></ul></li></ul>"
+        "<ol><li>One</li><li>Two<br>continued</li></ol><pre>code\n  indented</pre><p> </p>"
+        "<table><tr><th>Name</th><th>Value</th></tr><tr><td>Alpha</td><td>1</td></tr></table>"
+        "<p>before</p><script/><style/><p>after</p>"
+    )
+    assert note_blocks(note) == [
+        'Notes', 'First bold paragraph', 'Fish & chips', '- Point', '- Parent', '- Child',
+        '1. One', '2. Two', 'continued', 'code', '  indented', 'Name | Value', 'Alpha | 1',
+        'before', 'after'
+    ]